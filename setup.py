@@ -34,9 +34,13 @@ setup(
         'cogen >= 0.2.1, < 0.3',
         'Durus >= 3.9, < 4.0',
         ],
+    extras_require = {
+        'asyncio': ['trollius >= 2.0'],
+        },
     entry_points="""
     [console_scripts]
     xdserver = xdserver.server:main
     xdclient = xdserver.client:main
+    xdbench = xdserver.benchmark:main
     """,
     )
@@ -0,0 +1,44 @@
+import shutil
+import socket
+from tempfile import mkdtemp
+import unittest
+
+from xdserver.client import Client
+from xdserver.server import DEFAULT_HOST
+from xdserver.supervisor import start_server, wait_for_server
+
+
+def free_port():
+    listener = socket.socket()
+    listener.bind((DEFAULT_HOST, 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    return port
+
+
+class ServerTestCase(unittest.TestCase):
+    """Starts a server on a new directory for each test."""
+
+    # Command line options of the server.
+    server_options = []
+
+    def setUp(self):
+        self.path = mkdtemp(prefix='xdserver-test-')
+        self.port = free_port()
+        self.process = start_server(
+            [self.path, '--port', str(self.port), '--loglevel', '30']
+            + self.server_options)
+        wait_for_server(self.process, (DEFAULT_HOST, self.port))
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.disconnect()
+        Client(DEFAULT_HOST, self.port).quit()
+        self.process.wait()
+        shutil.rmtree(self.path)
+
+    def connect(self):
+        client = Client(DEFAULT_HOST, self.port)
+        self.clients.append(client)
+        return client
@@ -0,0 +1,48 @@
+import os
+import unittest
+
+from durus.connection import Connection
+from durus.persistent_dict import PersistentDict
+
+from tests import ServerTestCase
+
+
+class CacheFileTest(ServerTestCase):
+
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        self.cache_file = os.path.join(self.path, 'db.cache')
+        storage = self.connect().storage(
+            'db', cache_size=1000000, cache_file=self.cache_file)
+        connection = Connection(storage)
+        root = connection.get_root()
+        for i in range(10):
+            root[i] = PersistentDict()
+        connection.commit()
+        storage.close()
+
+    def test_check(self):
+        writer = Connection(self.connect().storage('db'))
+        writer.get_root()[0]['a'] = 1
+        writer.commit()
+        storage = self.connect().storage(
+            'db', cache_size=1000000, cache_file=self.cache_file)
+        # The changed record is dropped, and the others are kept.
+        self.assertEqual(len(storage.cache.spill), 10)
+        reader = Connection(storage)
+        self.assertEqual(reader.get_root()[0].items(), [('a', 1)])
+        storage.close()
+
+    def test_old_server(self):
+        # A server older than protocol 20002 cannot check records, so
+        # the file is emptied.
+        client = self.connect()
+        client.server_protocol_max = 20001
+        storage = client.storage(
+            'db', cache_size=1000000, cache_file=self.cache_file)
+        self.assertEqual(len(storage.cache.spill), 0)
+        storage.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
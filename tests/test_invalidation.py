@@ -0,0 +1,34 @@
+import unittest
+
+from durus.utils import int8_to_str
+
+from xdserver.invalidation import InvalidationLog
+
+
+A = int8_to_str(1)
+B = int8_to_str(2)
+
+
+class InvalidationLogTest(unittest.TestCase):
+
+    def test_compact(self):
+        log = InvalidationLog(10)
+        log.append([A], 'x')
+        log.append([A, B], 'y')
+        self.assertEqual(log.compact(1), [([A], 'x')])
+        self.assertEqual((log.start, log.oids), (1, 2))
+        self.assertTrue(log.is_invalid(A, 1, 'x'))
+        self.assertFalse(log.is_invalid(A, 1, 'y'))
+
+    def test_compact_repeated_oid(self):
+        log = InvalidationLog(10)
+        log.append([A, A, B], 'x')
+        log.append([B], 'y')
+        self.assertEqual(log.compact(2), [([A, A, B], 'x'), ([B], 'y')])
+        self.assertEqual((log.start, log.end, log.oids), (2, 2, 0))
+        self.assertFalse(A in log)
+        self.assertFalse(B in log)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+
+from durus.connection import Connection
+from durus.persistent_dict import PersistentDict
+
+from xdserver.client import Client
+from xdserver.server import DEFAULT_HOST
+
+from tests import ServerTestCase
+
+
+LOAD_LABELS = '{command="load",database="db"}'
+
+
+class MetricsTest(ServerTestCase):
+
+    framed = True
+
+    def load_bytes(self, client):
+        # Return the bytes received and sent for loads from 'db'.
+        counts = {}
+        for line in client.metrics().splitlines():
+            for name in ['received', 'sent']:
+                if line.startswith('xdserver_command_%s_bytes_total%s ' % (
+                    name, LOAD_LABELS)):
+                    counts[name] = int(line.split()[1])
+        return counts['received'], counts['sent']
+
+    def test_bytes(self):
+        writer = Connection(self.connect().storage('db'))
+        writer.get_root()['x'] = PersistentDict()
+        writer.commit()
+        oid = writer.get_root()['x']._p_oid
+        client = Client(DEFAULT_HOST, self.port, framed=self.framed)
+        self.clients.append(client)
+        storage = client.storage('db')
+        received, sent = self.load_bytes(client)
+        for i in range(3):
+            size = len(storage.load(oid))
+        # 'L', the name of the database and an oid; the status, the
+        # length of the record and the record.
+        self.assertEqual(self.load_bytes(client), (
+            received + 3 * (1 + 4 + 2 + 8), sent + 3 * (1 + 4 + size)))
+
+
+class UnframedMetricsTest(MetricsTest):
+
+    framed = False
+
+
+if __name__ == '__main__':
+    unittest.main()
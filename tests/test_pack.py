@@ -0,0 +1,51 @@
+from time import time
+import unittest
+
+from durus.btree import BTree
+from durus.connection import Connection
+from durus.persistent_dict import PersistentDict
+
+from tests import ServerTestCase
+
+
+class PackTest(ServerTestCase):
+
+    objects = 20000
+
+    def populate(self, storage):
+        connection = Connection(storage)
+        tree = connection.get_root()['tree'] = BTree()
+        for n in xrange(self.objects):
+            tree[n] = PersistentDict(payload='x' * 200)
+            if n % 1000 == 999:
+                connection.commit()
+        connection.commit()
+        return tree
+
+    def is_packing(self, client):
+        return 'xdserver_packing{database="db"} 1' in client.metrics()
+
+    def test_loads_during_pack(self):
+        client = self.connect()
+        storage = client.storage('db')
+        oids = [item._p_oid for item in self.populate(storage).itervalues()]
+        # Load each object once, so that none comes from a client cache.
+        reader = self.connect().storage('db')
+        times = []
+        storage.pack()
+        while oids and self.is_packing(client):
+            start = time()
+            reader.load(oids.pop())
+            times.append(time() - start)
+        self.assertTrue(len(times) > 10, times)
+        # Each load waits for at most one short slice of the pack.
+        self.assertTrue(sum(times) / len(times) < 0.01, times)
+
+
+class WorkersPackTest(PackTest):
+
+    server_options = ['--workers', '2']
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+from time import sleep, time
+import unittest
+
+from durus.connection import Connection
+from durus.persistent_dict import PersistentDict
+
+from tests import ServerTestCase
+
+
+class PushTest(ServerTestCase):
+
+    server_options = ['--push-interval', '0']
+
+    def test_push(self):
+        writer = Connection(self.connect().storage('db'))
+        writer.get_root()['x'] = PersistentDict()
+        writer.commit()
+        storage = self.connect().storage('db')
+        self.assertTrue(storage.subscribe())
+        reader = Connection(storage)
+        self.assertEqual(reader.get_root()['x'].items(), [])
+        writer.get_root()['x']['a'] = 1
+        writer.commit()
+        deadline = time() + 5
+        while not storage.pushes and time() < deadline:
+            sleep(0.01)
+        self.assertTrue(storage.pushes)
+        reader.abort()
+        self.assertEqual(reader.get_root()['x'].items(), [('a', 1)])
+
+
+class DelayedPushTest(PushTest):
+
+    server_options = ['--push-interval', '0.05']
+
+
+if __name__ == '__main__':
+    unittest.main()
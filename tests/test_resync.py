@@ -0,0 +1,43 @@
+import unittest
+
+from durus.connection import Connection
+from durus.persistent_dict import PersistentDict
+
+from tests import ServerTestCase
+
+
+class ResyncTest(ServerTestCase):
+
+    server_options = ['--log-size', '2']
+
+    def test_resync(self):
+        writer = Connection(self.connect().storage('db'))
+        root = writer.get_root()
+        for i in range(10):
+            root[i] = PersistentDict()
+        writer.commit()
+        storage = self.connect().storage('db')
+        reader = Connection(storage)
+        for i in range(10):
+            reader.get_root()[i].items()
+        self.assertEqual(len(storage.loaded_oids), 11)
+        # Fall behind the log, so that the reader is told to resync.
+        for i in range(5):
+            writer.abort()
+            writer.get_root()[i]['a'] = i
+            writer.commit()
+        reader.abort()
+        self.assertEqual(len(storage.loaded_oids), 0)
+        self.assertEqual(reader.get_root()[4].items(), [('a', 4)])
+        self.assertEqual(len(storage.loaded_oids), 2)
+        # Oids invalidated without a resync are forgotten as well.
+        writer.abort()
+        writer.get_root()[4]['a'] = 5
+        writer.commit()
+        reader.abort()
+        self.assertEqual(len(storage.loaded_oids), 1)
+        self.assertEqual(reader.get_root()[4].items(), [('a', 5)])
+
+
+if __name__ == '__main__':
+    unittest.main()
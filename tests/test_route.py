@@ -0,0 +1,60 @@
+from socket import error as socket_error
+from time import sleep, time
+import unittest
+
+from durus.connection import Connection
+from durus.utils import ShortRead
+
+from xdserver.client import Client
+from xdserver.server import DEFAULT_HOST
+
+from tests import ServerTestCase
+
+
+class RouteTest(ServerTestCase):
+
+    server_options = ['--processes', '2']
+
+    def route_count(self, client, db_name):
+        # Return the number of 'G' requests the supervisor answered for
+        # the named database.
+        name = ('xdserver_command_seconds_count{command="route",'
+                'database="%s"} ' % db_name)
+        for line in client.metrics().splitlines():
+            if line.startswith(name):
+                return int(line.split()[1])
+        return 0
+
+    def test_cached(self):
+        client = self.connect()
+        for i in range(3):
+            client.open('db')
+            Connection(client.storage('db')).commit()
+        client.close('db')
+        self.assertEqual(self.route_count(client, 'db'), 1)
+
+    def test_refused(self):
+        client = self.connect()
+        owner = client._route('db')
+        # Route the database to the process that does not own it, which
+        # refuses it and resets the connection.
+        ports = [self.port + 1, self.port + 2]
+        ports.remove(owner.address.port)
+        port = ports[0]
+        wrong = Client(DEFAULT_HOST, port)
+        client.db_routes['db'] = client.routes[(DEFAULT_HOST, port)] = wrong
+        deadline = time() + 5
+        while 'db' in client.db_routes and time() < deadline:
+            try:
+                client.open('db')
+            except (socket_error, ShortRead):
+                pass
+            sleep(0.01)
+        self.assertFalse('db' in client.db_routes)
+        self.assertFalse(wrong in client.routes.values())
+        Connection(client.storage('db')).commit()
+        self.assertEqual(client._route('db').address.port, owner.address.port)
+
+
+if __name__ == '__main__':
+    unittest.main()
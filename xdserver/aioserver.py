@@ -0,0 +1,240 @@
+__all__ = [
+    'AsyncioScheduler',
+    'AsyncioServer',
+    'StreamClient',
+    ]
+
+from datetime import datetime
+import socket
+import sys
+from traceback import format_exc
+from types import GeneratorType
+
+from cogen.core.coroutines import CoroutineInstance, coro
+from cogen.core.events import Signal, Sleep, WaitForSignal
+from cogen.core.sockets import ConnectionClosed, SocketError
+from durus.logger import log
+from durus.utils import join_bytes
+import trollius as asyncio
+from trollius import From, Return
+
+from xdserver.executor import StorageExecutor
+from xdserver.server import ConnectedClient, Server
+
+
+class AsyncioScheduler(object):
+    """Runs the server's coroutines on an asyncio event loop.
+
+    Server handlers are written once, as cogen coroutines that yield
+    other coroutines, :class:`Signal`, :class:`WaitForSignal` and
+    :class:`Sleep`.  This scheduler steps them from asyncio tasks in
+    place of cogen's own scheduler, so that both engines share them.
+
+    :param loop: Event loop to run on; the current one by default.
+    """
+
+    def __init__(self, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        # Signal name -> futures of the coroutines waiting for it.
+        self.waiting = {}
+
+    def add(self, func, args=(), kwargs={}):
+        """Start ``func(*args, **kwargs)``, a cogen coroutine, in a task
+        of its own, and return the task."""
+        return asyncio.ensure_future(
+            self._serve(func(*args, **kwargs)), loop=self.loop)
+
+    def run(self):
+        """Run the event loop until :meth:`stop` is called."""
+        self.loop.run_forever()
+
+    def stop(self):
+        self.loop.stop()
+
+    def signal(self, name):
+        """Resume the coroutines waiting for `name` to be signalled."""
+        for future in self.waiting.pop(name, ()):
+            if not future.done():
+                future.set_result(None)
+
+    @asyncio.coroutine
+    def _serve(self, instance):
+        # Log what cogen's scheduler would print for a failed coroutine.
+        try:
+            yield From(self._run(instance))
+        except Exception:
+            log(40, 'Coroutine %s failed:\n%s', instance.name, format_exc())
+
+    @asyncio.coroutine
+    def _run(self, instance):
+        # Step the generators of nested coroutines on a stack, so that a
+        # call from one to another does not need a task of its own.
+        stack = []
+        op = instance
+        while 1:
+            value = exc_info = None
+            try:
+                if isinstance(op, CoroutineInstance):
+                    value = op.coro(*op.f_args, **op.f_kws)
+                    if isinstance(value, GeneratorType):
+                        stack.append(value)
+                        value = None
+                elif isinstance(op, Signal):
+                    self.signal(op.name)
+                elif isinstance(op, WaitForSignal):
+                    future = asyncio.Future(loop=self.loop)
+                    self.waiting.setdefault(op.name, []).append(future)
+                    yield From(future)
+                elif isinstance(op, Sleep):
+                    yield From(asyncio.sleep(_seconds(op), loop=self.loop))
+                elif op is not None:
+                    # A future or asyncio coroutine, such as the reads
+                    # and writes of a StreamClient.
+                    value = yield From(op)
+            except Exception:
+                exc_info = sys.exc_info()
+            # Resume the innermost generator with the outcome, unwinding
+            # those that finish, until one yields its next operation.
+            while 1:
+                if not stack:
+                    if exc_info is not None:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                    raise Return(value)
+                try:
+                    if exc_info is None:
+                        op = stack[-1].send(value)
+                    else:
+                        op = stack[-1].throw(*exc_info)
+                    break
+                except StopIteration, e:
+                    stack.pop()
+                    value = e.args[0] if e.args else None
+                    exc_info = None
+                except Exception:
+                    stack.pop()
+                    value = None
+                    exc_info = sys.exc_info()
+
+
+def _seconds(sleep):
+    # Seconds until the time a cogen Sleep waits for.
+    if isinstance(sleep.timeout, datetime):
+        return max(0, (sleep.timeout - datetime.now()).total_seconds())
+    return 0
+
+
+class StreamClient(ConnectedClient):
+    """A client connected through asyncio streams.
+
+    Reads raise cogen's :class:`ConnectionClosed` and
+    :class:`SocketError`, as those of a :class:`ConnectedClient` do.
+    Writes are buffered until :meth:`flush`, which waits for the
+    transport to drain, so that a slow client holds back the requests
+    that answer it rather than filling the server's memory.
+    """
+
+    def __init__(self, reader, writer):
+        ConnectedClient.__init__(self, (reader, writer))
+
+    def _open(self, streams):
+        self.reader, self.writer = streams
+        self.address = '%s:%s' % self.writer.get_extra_info('peername')[:2]
+        self.output = []
+        self.is_closed = False
+
+    @property
+    def closed(self):
+        return self.is_closed
+
+    def reset(self):
+        self.is_closed = True
+        self.writer.transport.abort()
+
+    @asyncio.coroutine
+    def read(self, size):
+        self.received += size
+        try:
+            data = yield From(self.reader.readexactly(size))
+        except asyncio.IncompleteReadError:
+            raise ConnectionClosed('Connection closed.')
+        except socket.error, e:
+            raise SocketError(e)
+        raise Return(data)
+
+    @asyncio.coroutine
+    def write(self, data):
+        self.sent += len(data)
+        self.output.append(data)
+
+    @asyncio.coroutine
+    def flush(self):
+        if self.output:
+            data = join_bytes(self.output)
+            self.output = []
+            try:
+                self.writer.write(data)
+                yield From(self.writer.drain())
+            except socket.error, e:
+                raise SocketError(e)
+
+    @asyncio.coroutine
+    def close(self):
+        if not self.is_closed:
+            yield From(self.flush())
+            self.is_closed = True
+            self.writer.close()
+
+
+class AsyncioServer(Server):
+    """A :class:`Server` that accepts clients and waits for storage
+    worker threads through an :class:`AsyncioScheduler`.
+    """
+
+    @coro
+    def dispatch(self):
+        if self.workers:
+            yield self._start_executor()
+        yield asyncio.start_server(
+            self._accept, self.host, self.port, loop=self.scheduler.loop)
+        log(20, 'Listening on %s:%i' % (self.host, self.port))
+        self._start_tasks()
+
+    @coro
+    def serve_metrics(self):
+        yield asyncio.start_server(
+            self._serve_scrape, self.host, self.metrics_port,
+            loop=self.scheduler.loop)
+        log(20, 'Serving metrics on %s:%i' % (self.host, self.metrics_port))
+
+    @asyncio.coroutine
+    def _serve_scrape(self, reader, writer):
+        try:
+            # Skip the request line and headers.
+            while 1:
+                line = yield From(reader.readline())
+                if not line.strip():
+                    break
+            writer.write(self._scrape_response())
+            yield From(writer.drain())
+        except socket.error:
+            pass
+        writer.close()
+
+    def _accept(self, reader, writer):
+        log(20, 'Connection from %s:%s' % (
+            writer.get_extra_info('peername')[:2]))
+        self.scheduler.add(
+            self.serve_client,
+            args=(StreamClient(reader, writer),),
+            )
+
+    @coro
+    def _start_executor(self):
+        self.executor = StorageExecutor(self.workers, self._job_finished)
+        log(20, 'Using %i storage worker threads' % self.workers)
+
+    def _job_finished(self, job):
+        # Called from a worker thread.
+        self.scheduler.loop.call_soon_threadsafe(self.scheduler.signal, job)
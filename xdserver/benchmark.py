@@ -0,0 +1,417 @@
+__all__ = [
+    'Benchmark',
+    'Item',
+    ]
+
+from argparse import ArgumentParser
+import json
+from random import Random
+import shutil
+import socket
+import sys
+from tempfile import mkdtemp
+from threading import Thread
+from time import time
+
+from durus.btree import BTree
+from durus.connection import Connection
+from durus.error import ConflictError
+from durus.persistent import Persistent
+
+from xdserver.client import Client
+from xdserver.server import DEFAULT_HOST
+from xdserver.supervisor import start_server, wait_for_server
+
+
+WORKLOADS = ['load', 'bulk_load', 'commit', 'new_oid', 'sync', 'pack',
+             'mixed']
+
+# Relative weights of the commands in the mixed workload.  The pack
+# workload runs it in every worker, and the first also starts a pack
+# every PACK_INTERVAL seconds.
+MIXED_WEIGHTS = [
+    ('load', 60),
+    ('bulk_load', 10),
+    ('commit', 15),
+    ('new_oid', 10),
+    ('sync', 5),
+    ]
+
+PACK_INTERVAL = 1.0
+
+PERCENTILES = [50, 90, 99]
+
+DEFAULT_DB_NAME = 'benchmark'
+
+# Items committed at a time when populating the database.
+POPULATE_BATCH_SIZE = 1000
+
+
+class Item(Persistent):
+    """Object of the benchmark database, holding a random `payload`."""
+
+    def __init__(self, payload):
+        self.payload = payload
+
+
+class Benchmark(object):
+    """Times the commands of concurrent clients of one database.
+
+    Each worker is a thread with a :class:`~xdserver.client.Client` and
+    :class:`~xdserver.client.ClientStorage` of its own.  Workers choose
+    oids with random generators seeded from `seed`, so that runs with
+    the same settings make the same requests.
+
+    :param workers: Number of concurrent clients.
+    :param objects: Number of items in the database.
+    :param object_size: Bytes in the payload of each item.
+    :param bulk_size: Oids loaded by each bulk load.
+    :param commit_size: Records stored by each commit.  Each worker
+      commits only its own share of the items, so that commits do not
+      conflict.
+    :param cache_size: Bytes of records each storage caches.
+    :param seed: Seed of the random generators.
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=None, db_name=DEFAULT_DB_NAME,
+                 workers=4, objects=10000, object_size=128, bulk_size=100,
+                 commit_size=10, cache_size=0, seed=0):
+        self.host = host
+        self.port = port
+        self.db_name = db_name
+        self.workers = workers
+        self.objects = objects
+        self.object_size = object_size
+        self.bulk_size = bulk_size
+        self.commit_size = commit_size
+        self.cache_size = cache_size
+        self.seed = seed
+        self.oids = []
+
+    def populate(self):
+        """Fill the database with :attr:`objects` items in a BTree."""
+        client = Client(self.host, self.port)
+        try:
+            connection = Connection(client.storage(self.db_name))
+            tree = connection.get_root()['items'] = BTree()
+            random = Random(self.seed)
+            for n in xrange(self.objects):
+                tree[n] = Item(_payload(random, self.object_size))
+                if n % POPULATE_BATCH_SIZE == POPULATE_BATCH_SIZE - 1:
+                    connection.commit()
+            connection.commit()
+            self.oids = [item._p_oid for item in tree.itervalues()]
+        finally:
+            client.disconnect()
+
+    def run(self, workload, duration):
+        """Run `workload` for `duration` seconds.
+
+        :return: Count, rate, conflicts and latency percentiles of each
+          command, in seconds.
+        :rtype: dict
+        """
+        workers = [Worker(self, index) for index in xrange(self.workers)]
+        start = time()
+        deadline = start + duration
+        threads = [
+            Thread(target=worker.run, args=(workload, deadline))
+            for worker in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time() - start
+        for worker in workers:
+            worker.close()
+        for worker in workers:
+            if worker.exc_info is not None:
+                exc_info = worker.exc_info
+                raise exc_info[0], exc_info[1], exc_info[2]
+        timings = {}
+        conflicts = {}
+        for worker in workers:
+            for command, times in worker.timings.items():
+                timings.setdefault(command, []).extend(times)
+            for command, count in worker.conflicts.items():
+                conflicts[command] = conflicts.get(command, 0) + count
+        commands = {}
+        for command in set(timings) | set(conflicts):
+            commands[command] = _summary(
+                timings.get(command, []), conflicts.get(command, 0),
+                seconds)
+        count = sum(summary['count'] for summary in commands.values())
+        return dict(
+            workload=workload,
+            seconds=seconds,
+            count=count,
+            per_second=count / seconds,
+            commands=commands,
+            )
+
+
+class Worker(object):
+    """One client of a :class:`Benchmark`, with a method for each
+    command it times."""
+
+    def __init__(self, benchmark, index):
+        self.benchmark = benchmark
+        self.index = index
+        self.random = Random('%s-%s' % (benchmark.seed, index))
+        self.client = Client(benchmark.host, benchmark.port)
+        self.storage = self.client.storage(
+            benchmark.db_name, cache_size=benchmark.cache_size)
+        # The items this worker commits, with their records.
+        self.own_oids = benchmark.oids[index::benchmark.workers]
+        self.records = dict(
+            zip(self.own_oids, self.storage.bulk_load(self.own_oids)))
+        # Command -> seconds taken by each call, and conflicts raised.
+        self.timings = {}
+        self.conflicts = {}
+        self.exc_info = None
+        self.next_pack = 0
+
+    def run(self, workload, deadline):
+        try:
+            while time() < deadline:
+                command = self._choose(workload)
+                start = time()
+                try:
+                    getattr(self, command)()
+                except ConflictError:
+                    self.conflicts[command] = (
+                        self.conflicts.get(command, 0) + 1)
+                    self.storage.sync()
+                    self.storage.begin()
+                else:
+                    self.timings.setdefault(command, []).append(
+                        time() - start)
+        except Exception:
+            self.exc_info = sys.exc_info()
+
+    def close(self):
+        self.client.disconnect()
+
+    def _choose(self, workload):
+        if workload == 'pack':
+            if self.index == 0 and time() >= self.next_pack:
+                self.next_pack = time() + PACK_INTERVAL
+                return 'pack'
+            workload = 'mixed'
+        if workload == 'mixed':
+            n = self.random.randrange(sum(w for c, w in MIXED_WEIGHTS))
+            for command, weight in MIXED_WEIGHTS:
+                if n < weight:
+                    return command
+                n -= weight
+        return workload
+
+    def load(self):
+        self.storage.load(self.random.choice(self.benchmark.oids))
+
+    def bulk_load(self):
+        oids = self.benchmark.oids
+        oids = self.random.sample(
+            oids, min(self.benchmark.bulk_size, len(oids)))
+        list(self.storage.bulk_load(oids))
+
+    def commit(self):
+        oids = self.random.sample(
+            self.own_oids, min(self.benchmark.commit_size,
+                               len(self.own_oids)))
+        storage = self.storage
+        # Start from the latest state, as a connection's transactions
+        # do, so that the commit does not conflict with others' changes.
+        storage.sync()
+        storage.begin()
+        for oid in oids:
+            storage.store(oid, self.records[oid])
+        storage.end(_ignore_invalidations)
+
+    def new_oid(self):
+        # Ask the server for one oid.  ClientStorage.new_oid would
+        # mostly take oids from the storage's own pool.
+        storage = self.storage
+        request_id = storage._send_command('M', chr(1))
+        storage.client._response(request_id).read(8)
+
+    def sync(self):
+        self.storage.sync()
+
+    def pack(self):
+        self.storage.pack()
+
+
+def _ignore_invalidations(oids):
+    # Workers hold no objects for invalidations to conflict with.
+    pass
+
+
+def _payload(random, size):
+    if not size:
+        return ''
+    return ('%0*x' % (2 * size, random.getrandbits(8 * size))).decode('hex')
+
+
+def _summary(times, conflicts, seconds):
+    times = sorted(times)
+    summary = dict(
+        count=len(times),
+        per_second=len(times) / seconds,
+        conflicts=conflicts,
+        mean=None,
+        max=None,
+        )
+    if times:
+        summary['mean'] = sum(times) / len(times)
+        summary['max'] = times[-1]
+    for percentile in PERCENTILES:
+        summary['p%s' % percentile] = _percentile(times, percentile)
+    return summary
+
+
+def _percentile(times, percentile):
+    # Nearest-rank percentile of sorted `times`.
+    if not times:
+        return None
+    rank = (len(times) * percentile + 99) // 100
+    return times[max(rank, 1) - 1]
+
+
+def _free_port(host):
+    listener = socket.socket()
+    listener.bind((host, 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    return port
+
+
+def _print_summary(report, previous, out):
+    # Lines of text for people; the JSON report is for programs.
+    old = {}
+    if previous is not None:
+        for result in previous['results']:
+            for command, summary in result['commands'].items():
+                old[result['workload'], command] = summary
+    for result in report['results']:
+        print >>out, '%s: %.0f commands/s over %.1fs' % (
+            result['workload'], result['per_second'], result['seconds'])
+        for command, summary in sorted(result['commands'].items()):
+            line = '  %-10s %8i %10.1f/s  p50 %s  p99 %s  conflicts %i' % (
+                command, summary['count'], summary['per_second'],
+                _ms(summary['p50']), _ms(summary['p99']),
+                summary['conflicts'])
+            before = old.get((result['workload'], command))
+            if before and before['per_second'] and before['p99']:
+                line += '  (%+.0f%% rate, %+.0f%% p99)' % (
+                    100.0 * summary['per_second'] / before['per_second']
+                    - 100,
+                    100.0 * (summary['p99'] or 0) / before['p99'] - 100)
+            print >>out, line
+
+
+def _ms(seconds):
+    if seconds is None:
+        return '-'
+    return '%.2fms' % (seconds * 1000)
+
+
+def main():
+    parser = ArgumentParser(
+        description='Time the commands of concurrent clients of a new '
+        'xdserver')
+    parser.add_argument(
+        '--workloads', type=str, default='mixed',
+        help='Comma-separated workloads to run, of %s.' % ', '.join(
+            WORKLOADS))
+    parser.add_argument(
+        '--duration', type=float, default=10.0,
+        help='Seconds to run each workload.')
+    parser.add_argument(
+        '--workers', type=int, default=4,
+        help='Number of concurrent clients.')
+    parser.add_argument(
+        '--objects', type=int, default=10000,
+        help='Number of objects in the database.')
+    parser.add_argument(
+        '--object-size', type=int, default=128,
+        help='Bytes of data in each object.')
+    parser.add_argument(
+        '--bulk-size', type=int, default=100,
+        help='Objects loaded by each bulk load.')
+    parser.add_argument(
+        '--commit-size', type=int, default=10,
+        help='Objects stored by each commit.')
+    parser.add_argument(
+        '--cache-size', type=int, default=0,
+        help='Bytes of records each client caches.')
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='Seed of the random choices of objects and commands.')
+    parser.add_argument(
+        '--host', type=str, default=DEFAULT_HOST,
+        help='Interface for the server to serve on.')
+    parser.add_argument(
+        '--port', type=int, default=0,
+        help='Port for the server to serve on; 0 picks a free one.')
+    parser.add_argument(
+        '--server-option', action='append', default=[],
+        help='Command line option for the server, such as '
+        '--server-option=--workers=4.  May be repeated.')
+    parser.add_argument(
+        '--output', type=str, default='-',
+        help='File to write the JSON report to; - writes to stdout.')
+    parser.add_argument(
+        '--compare', type=str, default=None,
+        help='JSON report of an earlier run to compare with.')
+    args = parser.parse_args()
+    workloads = args.workloads.split(',')
+    for workload in workloads:
+        if workload not in WORKLOADS:
+            parser.error('unknown workload %r' % workload)
+    previous = None
+    if args.compare is not None:
+        previous = json.load(open(args.compare))
+    port = args.port or _free_port(args.host)
+    path = mkdtemp(prefix='xdbench-')
+    process = start_server(
+        [path, '--host', args.host, '--port', str(port), '--loglevel', '30']
+        + args.server_option)
+    try:
+        wait_for_server(process, (args.host, port))
+        benchmark = Benchmark(
+            host=args.host,
+            port=port,
+            workers=args.workers,
+            objects=args.objects,
+            object_size=args.object_size,
+            bulk_size=args.bulk_size,
+            commit_size=args.commit_size,
+            cache_size=args.cache_size,
+            seed=args.seed,
+            )
+        benchmark.populate()
+        results = []
+        for workload in workloads:
+            results.append(benchmark.run(workload, args.duration))
+    finally:
+        if process.poll() is None:
+            try:
+                Client(args.host, port).quit()
+            except socket.error:
+                process.terminate()
+            process.wait()
+        shutil.rmtree(path)
+    settings = dict(vars(args))
+    del settings['output'], settings['compare']
+    settings['python'] = sys.version.split()[0]
+    report = dict(settings=settings, results=results)
+    if args.output == '-':
+        out = sys.stdout
+    else:
+        out = open(args.output, 'w')
+    json.dump(report, out, indent=2, sort_keys=True)
+    out.write('\n')
+    if out is not sys.stdout:
+        out.close()
+    _print_summary(report, previous, sys.stderr)
@@ -0,0 +1,151 @@
+__all__ = [
+    'RecordCache',
+    ]
+
+
+class RecordCache(object):
+    """Least-recently-used cache of records, bounded by their total size.
+
+    Only the lengths of the records count toward `max_bytes`; the
+    per-record overhead of the cache itself is not included.
+
+    Records pushed out of memory are moved to `spill` if one is given.
+    It may be any mapping of oids to records, such as a file opened
+    with :mod:`anydbm`, and its contents are not bounded.
+
+    :param max_bytes: Total length of records to keep in memory.  Use 0
+      to disable the cache or, with a `spill` mapping, to keep records
+      only in the mapping.
+    :type max_bytes: integer
+    :param spill: Mapping to move records to when they are evicted.
+    """
+
+    def __init__(self, max_bytes, spill=None):
+        self.max_bytes = max_bytes
+        self.spill = spill
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Incremented by every invalidation; see `put`.
+        self.generation = 0
+        # oid -> [previous, next, oid, record] link in a circular list.
+        # The root's next link is the least recently used record.
+        self.links = {}
+        self.root = root = []
+        root[:] = [root, root, None, None]
+
+    def __contains__(self, oid):
+        return oid in self.links or (
+            self.spill is not None and oid in self.spill)
+
+    def __len__(self):
+        return len(self.links)
+
+    def __str__(self):
+        return '%s records, %s bytes, %s hits, %s misses, %s evictions' % (
+            len(self.links), self.bytes, self.hits, self.misses,
+            self.evictions)
+
+    def get(self, oid):
+        """Return the cached record for `oid`, or None."""
+        link = self.links.get(oid)
+        if link is None:
+            if self.spill is not None and oid in self.spill:
+                self.hits += 1
+                record = self.spill[oid]
+                self._put(oid, record)
+                return record
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._unlink(link)
+        self._append(link)
+        return link[3]
+
+    def put(self, oid, record, generation=None):
+        """Cache `record` for `oid`.
+
+        If `generation` is given and the cache has been invalidated
+        since it was read from :attr:`generation`, the record may
+        already be stale and is not cached.
+        """
+        if generation is not None and generation != self.generation:
+            return
+        self.discard(oid)
+        self._put(oid, record)
+
+    def discard(self, oid):
+        """Remove `oid` from the cache if it is present."""
+        self._remove(oid)
+        if self.spill is not None and oid in self.spill:
+            del self.spill[oid]
+
+    def invalidate(self, oids):
+        """Remove all of `oids` from the cache."""
+        self.generation += 1
+        if self.spill is None:
+            # Find the few cached oids among many in one set operation.
+            oids = self.links.viewkeys() & oids
+        for oid in oids:
+            self.discard(oid)
+
+    def clear(self):
+        self.generation += 1
+        self.links.clear()
+        root = self.root
+        root[:] = [root, root, None, None]
+        self.bytes = 0
+        if self.spill is not None:
+            for oid in self.spill.keys():
+                del self.spill[oid]
+
+    def close(self):
+        """Move all records to `spill`, then close it if it can be."""
+        if self.spill is None:
+            return
+        root = self.root
+        while root[1] is not root:
+            self._evict()
+        if hasattr(self.spill, 'close'):
+            self.spill.close()
+        self.spill = None
+
+    def _put(self, oid, record):
+        size = len(record)
+        if size > self.max_bytes:
+            if self.spill is not None:
+                self.spill[oid] = record
+            return
+        link = [None, None, oid, record]
+        self._append(link)
+        self.links[oid] = link
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            self._evict()
+            self.evictions += 1
+
+    def _evict(self):
+        oid, record = self.root[1][2:]
+        self._remove(oid)
+        if self.spill is not None:
+            self.spill[oid] = record
+
+    def _remove(self, oid):
+        link = self.links.pop(oid, None)
+        if link is not None:
+            self._unlink(link)
+            self.bytes -= len(link[3])
+
+    def _append(self, link):
+        # Make `link` the most recently used.
+        root = self.root
+        last = root[0]
+        link[0] = last
+        link[1] = root
+        last[1] = root[0] = link
+
+    def _unlink(self, link):
+        previous, next = link[0], link[1]
+        previous[1] = next
+        next[0] = previous
@@ -1,16 +1,25 @@
 __all__ = [
     'Client',
+    'ClientPool',
     'ClientStorage',
+    'CommitSizeError',
     ]
 
+import anydbm
+from collections import deque
+from select import select
+from socket import SHUT_RDWR, error as socket_error
 import sys
+from threading import Condition, Lock, Thread
+from time import time
 
 from argparse import ArgumentParser
 
 from durus.connection import Connection
 from durus.error import (
-    ConflictError, DurusKeyError, ProtocolError, ReadConflictError)
-from durus.serialize import split_oids
+    ConflictError, DurusError, DurusKeyError, ProtocolError,
+    ReadConflictError, WriteConflictError)
+from durus.serialize import split_oids, unpack_record
 from durus.storage import Storage
 from durus.storage_server import (
     SocketAddress,
@@ -19,35 +28,326 @@ from durus.storage_server import (
 from durus.utils import (
     iteritems,
     as_bytes, join_bytes,
-    int4_to_str,
-    read, read_int4, write, write_all, write_int4, write_int4_str,
+    int4_to_str, str_to_int4,
+    read, read_int4, write, write_all,
+    ShortRead,
     )
 
-from xdserver.server import DEFAULT_HOST, DEFAULT_PORT, PROTOCOL
+from xdserver.cache import RecordCache
+from xdserver.server import (
+    CHUNKED_COMMIT, CHUNKED_COMMIT_PROTOCOL, COMMIT_CHUNK_SIZE,
+    DEFAULT_HOST, DEFAULT_PORT, EARLY_CONFLICT_PROTOCOL, FRAMED_PROTOCOL,
+    MAX_PROTOCOL, METRICS_PROTOCOL, OID_RANGES_PROTOCOL, PREFETCH_PROTOCOL,
+    PROTOCOL, PUSH_PROTOCOL, RESYNC, RESYNC_PROTOCOL, ROUTE_PROTOCOL,
+    STATUS_TOO_LARGE, WRITE_SET, record_digest, unpack_oid_ranges)
+
+
+# Number of cached records to check with each 'H' command.
+CHECK_BATCH_SIZE = 1024
+
+# Bounds of the number of oids a storage requests at a time.
+OID_POOL_MIN = 32
+OID_POOL_MAX = 1 << 16
+
+# The oid pool grows while it runs out within this many seconds of
+# being filled, and shrinks when it lasts longer.
+OID_POOL_INTERVAL = 1.0
+
+# Default number of references away from a loaded record that records
+# are prefetched.
+PREFETCH_DEPTH = 4
+
+# Bytes of a transaction from which its oids are sent ahead of it, so
+# that the server can refuse it before it is sent if it conflicts.
+EARLY_CONFLICT_SIZE = 1 << 16
+
+# Defaults for ClientPool: the most clients it connects, and the seconds
+# a client may be idle before it is checked with the server again.
+DEFAULT_POOL_SIZE = 8
+DEFAULT_CHECK_INTERVAL = 30.0
+
+
+class CommitSizeError(DurusError):
+    """Raised when a commit is larger than the server accepts."""
 
 
 class Client(object):
     """Connects to a xdserver server.
 
+    If the server supports it, requests and responses are sent in frames
+    tagged with request ids.  Several threads may then share one client,
+    each using its own :class:`ClientStorage`, without waiting for the
+    responses to each other's requests.
+
+    When databases are shared among several server processes, requests
+    for each database are sent on a connection of their own to the
+    process that owns it.
+
     :param host: Host name or IP address of server to connect to.
     :type host: string
     :param port: Port server is listening on.
     :type port: integer
+    :param framed: Use frames if the server supports them.
+    :type framed: boolean
     """
 
-    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, framed=True):
         self.address = SocketAddress.new((host, port))
+        self.framed = framed
         self.socket = self.address.get_connected_socket()
         assert self.socket, 'Could not connect to %s' % (self.address)
-        if self.server_protocol() != PROTOCOL:
+        self.protocol = str_to_int4(PROTOCOL)
+        self.request_id = 0
+        self.session = 0
+        # Request id -> responses received but not yet read.
+        self.responses = {}
+        self.reading = False
+        self.condition = Condition()
+        self.write_lock = Lock()
+        # Session number -> subscribed storage, and the thread reading
+        # frames once there is one.
+        self.subscribers = {}
+        self.reader = None
+        # Address -> client connected to another server process, and
+        # database name -> client of the process that owns it.
+        self.routes = {}
+        self.db_routes = {}
+        self.route_lock = Lock()
+        # Ask for the newest protocol before the one every server speaks.
+        # Servers that only speak PROTOCOL ignore 'U'.
+        write(self.socket, 'UV')
+        version = read(self.socket, 4)
+        if version == PROTOCOL:
+            self.server_protocol_max = self.protocol
+        else:
+            self.server_protocol_max = str_to_int4(version)
+            version = read(self.socket, 4)
+        if version != PROTOCOL:
             raise ProtocolError("Protocol version mismatch.")
+        if framed and self.server_protocol_max >= FRAMED_PROTOCOL:
+            write_all(self.socket, 'F', int4_to_str(MAX_PROTOCOL))
+            self.protocol = read_int4(self.socket)
+
+    def _new_session(self):
+        """Return the number of a new session, or 0 if not framed."""
+        if self.protocol < FRAMED_PROTOCOL:
+            return 0
+        self.write_lock.acquire()
+        try:
+            self.session += 1
+            return self.session
+        finally:
+            self.write_lock.release()
+
+    def _request(self, *parts):
+        """Send a request and return its id, or None if not framed."""
+        return self._session_request(0, *parts)
+
+    def _session_request(self, session, *parts):
+        """Send a request made in a session and return its id."""
+        if self.protocol < FRAMED_PROTOCOL:
+            write_all(self.socket, *parts)
+            return None
+        self.write_lock.acquire()
+        try:
+            # Request id 0 is not used.
+            self.request_id = self.request_id % 0xFFFFFFFF + 1
+            request_id = self.request_id
+            self._send_frame(request_id, session, parts)
+        finally:
+            self.write_lock.release()
+        return request_id
+
+    def _continue(self, request_id, *parts):
+        """Send more of a request the server has partly answered."""
+        if request_id is None:
+            write_all(self.socket, *parts)
+            return
+        self.write_lock.acquire()
+        try:
+            self._send_frame(request_id, 0, parts)
+        finally:
+            self.write_lock.release()
+
+    def _send_frame(self, request_id, session, parts):
+        length = sum(len(part) for part in parts)
+        pending = [
+            int4_to_str(request_id), int4_to_str(session), int4_to_str(length)]
+        for part in parts:
+            if len(part) < COMMIT_CHUNK_SIZE:
+                pending.append(part)
+            else:
+                # Send a large part as it is, not copied into the frame.
+                write_all(self.socket, *pending)
+                write(self.socket, part)
+                pending = []
+        if pending:
+            write_all(self.socket, *pending)
+
+    def _response(self, request_id):
+        """Return the next response to a request, to read from."""
+        if request_id is None:
+            return SocketResponse(self.socket)
+        condition = self.condition
+        condition.acquire()
+        try:
+            while request_id not in self.responses:
+                if self.reading:
+                    # Another thread is reading a frame from the socket.
+                    condition.wait()
+                    continue
+                self.reading = True
+                condition.release()
+                try:
+                    frame_id = read_int4(self.socket)
+                    data = read(self.socket, read_int4(self.socket))
+                finally:
+                    condition.acquire()
+                    self.reading = False
+                self._receive_frame(frame_id, data)
+                condition.notifyAll()
+            responses = self.responses[request_id]
+            data = responses.pop(0)
+            if not responses:
+                del self.responses[request_id]
+        finally:
+            condition.release()
+        return FrameResponse(data)
+
+    def _receive_frame(self, frame_id, data):
+        # Called with the condition held.
+        if frame_id == 0:
+            # Invalidations pushed to a subscribed storage.
+            response = FrameResponse(data)
+            session = response.read_int4()
+            response.read(response.read_int4())
+            storage = self.subscribers.get(session)
+            if storage is not None:
+                storage.pushes.append(response)
+        else:
+            self.responses.setdefault(frame_id, []).append(data)
+
+    def _start_reader(self):
+        # Read frames in a thread of their own, so that pushes are
+        # received while no request is waiting for a response.
+        condition = self.condition
+        condition.acquire()
+        try:
+            # Another thread may start the reader while this one waits.
+            while self.reading and self.reader is None:
+                condition.wait()
+            if self.reader is not None:
+                return
+            self.reading = True
+            self.reader = Thread(
+                target=self._read_frames, name='xdserver-client-reader')
+            self.reader.setDaemon(True)
+            self.reader.start()
+            condition.notifyAll()
+        finally:
+            condition.release()
+
+    def _read_frames(self):
+        condition = self.condition
+        while 1:
+            try:
+                frame_id = read_int4(self.socket)
+                data = read(self.socket, read_int4(self.socket))
+            except Exception:
+                frame_id = None
+            condition.acquire()
+            try:
+                if frame_id is None:
+                    # Let waiting threads read, and fail, for themselves.
+                    self.reading = False
+                    self.reader = None
+                else:
+                    self._receive_frame(frame_id, data)
+                condition.notifyAll()
+            finally:
+                condition.release()
+            if frame_id is None:
+                break
+
+    def _route(self, db_name):
+        """Return the client connected to the server process that owns
+        the named database.
+
+        The server is asked once for each database; see
+        :meth:`_forget_route`.
+        """
+        client = self.db_routes.get(db_name)
+        if client is None:
+            client = self.db_routes[db_name] = self._find_route(db_name)
+        return client
+
+    def _find_route(self, db_name):
+        if self.server_protocol_max < ROUTE_PROTOCOL:
+            return self
+        request_id = self._request('G', self._database_name(db_name))
+        response = self._response(request_id)
+        port = response.read(response.read_int4())
+        if not port:
+            return self
+        # The server processes share the host this client connected to.
+        address = (self.address.host, int(port))
+        self.route_lock.acquire()
+        try:
+            if address not in self.routes:
+                self.routes[address] = Client(
+                    address[0], address[1], self.framed)
+            return self.routes[address]
+        finally:
+            self.route_lock.release()
+
+    def _forget_route(self, db_name):
+        # Called when a request for the named database to the process
+        # that owns it fails.  A process refusing a database it does not
+        # serve resets the connection, so drop the client and every
+        # route through it, and ask the server again next time.
+        client = self.db_routes.pop(db_name, None)
+        if client is None or client is self:
+            return
+        self.route_lock.acquire()
+        try:
+            for address, routed in self.routes.items():
+                if routed is client:
+                    del self.routes[address]
+            for name, routed in self.db_routes.items():
+                if routed is client:
+                    del self.db_routes[name]
+        finally:
+            self.route_lock.release()
+        try:
+            client.disconnect()
+        except (socket_error, ShortRead):
+            pass
+
+    def _route_request(self, db_name, command):
+        # Send a request that has no response for the named database to
+        # the process that owns it.
+        client = self._route(db_name)
+        try:
+            client._request(command, client._database_name(db_name))
+        except (socket_error, ShortRead):
+            self._forget_route(db_name)
+            raise
 
     # Server commands.
 
     def disconnect(self):
         """Disconnect from the server."""
+        for client in self.routes.values():
+            client.disconnect()
+        self.routes.clear()
+        self.db_routes.clear()
         if self.socket is not None:
-            write(self.socket, '.')
+            self._request('.')
+            reader = self.reader
+            if reader is not None:
+                # Wake the reader from its blocking read, then wait for it.
+                self.socket.shutdown(SHUT_RDWR)
+                reader.join()
             self.socket.close()
             self.socket = None
 
@@ -56,25 +356,45 @@ class Client(object):
 
         :rtype: list of strings
         """
-        write(self.socket, 'A')
-        return list(self._enumerate_database_names())
+        request_id = self._request('A')
+        return list(self._enumerate_database_names(request_id))
 
     def list_open(self):
         """List open databases on server.
 
+        Of the other server processes, only those this client has
+        connected to are asked.
+
         :rtype: List of strings
         """
-        write(self.socket, 'E')
-        return list(self._enumerate_database_names())
+        request_id = self._request('E')
+        names = list(self._enumerate_database_names(request_id))
+        for client in self.routes.values():
+            names.extend(client.list_open())
+        return names
 
-    def _enumerate_database_names(self):
-        count = read_int4(self.socket)
+    def _enumerate_database_names(self, request_id):
+        response = self._response(request_id)
+        count = response.read_int4()
         while count > 0:
             count -= 1
-            length = read_int4(self.socket)
-            database_name = read(self.socket, length)
+            length = response.read_int4()
+            database_name = response.read(length)
             yield database_name
 
+    def metrics(self):
+        """Get the server's metrics, in the Prometheus text format.
+
+        Each server process reports only its own databases.
+
+        :rtype: string
+        """
+        if self.server_protocol_max < METRICS_PROTOCOL:
+            raise ProtocolError('server does not report metrics')
+        request_id = self._request('I')
+        response = self._response(request_id)
+        return response.read(response.read_int4())
+
     def quit(self):
         """Shut down the server process and disconnect.
 
@@ -84,7 +404,11 @@ class Client(object):
            or if a server should only be shut down by process control
            on the system that the server is running on.
         """
-        write(self.socket, 'Q')
+        for client in self.routes.values():
+            client.disconnect()
+        self.routes.clear()
+        self.db_routes.clear()
+        self._request('Q')
         self.disconnect()
 
     def server_protocol(self):
@@ -92,14 +416,13 @@ class Client(object):
 
         :rtype: 4-byte string
         """
-        write(self.socket, 'V')
-        return read(self.socket, 4)
+        request_id = self._request('V')
+        return self._response(request_id).read(4)
 
     # Database commands.
 
-    def _write_database_name(self, db_name):
-        write_int4(self.socket, len(db_name))
-        write(self.socket, db_name)
+    def _database_name(self, db_name):
+        return int4_to_str(len(db_name)) + db_name
 
     def close(self, db_name):
         """Close the named database.
@@ -107,8 +430,7 @@ class Client(object):
         :param db_name: Name of database to close.
         :ptype db_name: string
         """
-        write(self.socket, 'X')
-        self._write_database_name(db_name)
+        self._route_request(db_name, 'X')
 
     def destroy(self, db_name):
         """Destroy the named database.
@@ -125,8 +447,7 @@ class Client(object):
            This will permanently delete the file containing the
            database on the server.
         """
-        write(self.socket, 'D')
-        self._write_database_name(db_name)
+        self._route_request(db_name, 'D')
 
     def open(self, db_name):
         """Open the named database.
@@ -134,10 +455,9 @@ class Client(object):
         :param db_name: Name of database to open.
         :ptype db_name: string
         """
-        write(self.socket, 'O')
-        self._write_database_name(db_name)
+        self._route_request(db_name, 'O')
 
-    def storage(self, db_name):
+    def storage(self, db_name, cache_size=0, cache_file=None, prefetch=0):
         """Return a Durus storage object for the named database.
 
         The database is opened on the server if it was not open
@@ -145,10 +465,212 @@ class Client(object):
 
         :param db_name: Name of database to return storage object for.
         :ptype db_name: string
+        :param cache_size: Total bytes of records to cache in memory.
+        :type cache_size: integer
+        :param cache_file: Name of a file to keep cached records in
+          between sessions.
+        :type cache_file: string
+        :param prefetch: Bytes of the records a loaded record refers to
+          that the server may send along with it, to be cached.
+        :type prefetch: integer
         :rtype: :class:`ClientStorage`
         """
-        self.open(db_name)
-        return ClientStorage(self, db_name)
+        client = self._route(db_name)
+        if client is not self:
+            try:
+                return client.storage(
+                    db_name, cache_size, cache_file, prefetch)
+            except (socket_error, ShortRead):
+                self._forget_route(db_name)
+                raise
+        session = self._new_session()
+        self._session_request(session, 'O', self._database_name(db_name))
+        return ClientStorage(
+            self, db_name, cache_size, cache_file, session, prefetch)
+
+
+class ClientPool(object):
+    """Keeps clients connected to a xdserver server for threads to take
+    in turn.
+
+    Clients are connected, and their protocol agreed with the server,
+    once; a thread that takes one does not pay for that again.  A client
+    that has been idle for longer than `check_interval` is checked with
+    the server before it is handed out, and replaced if its connection
+    has been lost.
+
+    :param host: Host name or IP address of server to connect to.
+    :type host: string
+    :param port: Port server is listening on.
+    :type port: integer
+    :param framed: Use frames if the server supports them.
+    :type framed: boolean
+    :param size: Most clients to have connected at once.
+      :meth:`checkout` waits while all of them are taken.
+    :type size: integer
+    :param check_interval: Seconds a client may be idle before it is
+      checked with the server.
+    :type check_interval: float
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, framed=True,
+                 size=DEFAULT_POOL_SIZE,
+                 check_interval=DEFAULT_CHECK_INTERVAL):
+        self.host = host
+        self.port = port
+        self.framed = framed
+        self.size = size
+        self.check_interval = check_interval
+        self.condition = Condition()
+        # (client, time it was given back) of each idle client, the most
+        # recently used last, and the number of clients connected.
+        self.idle = []
+        self.count = 0
+        self.closed = False
+
+    def checkout(self):
+        """Take a client, connecting one if none are idle.
+
+        :rtype: :class:`Client`
+        """
+        condition = self.condition
+        condition.acquire()
+        try:
+            while not self.idle and self.count >= self.size:
+                condition.wait()
+            if self.idle:
+                client, returned = self.idle.pop()
+            else:
+                client = None
+                self.count += 1
+        finally:
+            condition.release()
+        if client is not None:
+            if self._is_connected(client, returned):
+                return client
+            # Connect another in its place.
+            self._close(client)
+        try:
+            return Client(self.host, self.port, self.framed)
+        except Exception:
+            self._forget()
+            raise
+
+    def checkin(self, client):
+        """Give back a client taken with :meth:`checkout`."""
+        if self.closed or client.socket is None or client.subscribers:
+            # Not reused: pushes may still arrive for its sessions.
+            self._drop(client)
+            return
+        condition = self.condition
+        condition.acquire()
+        try:
+            self.idle.append((client, time()))
+            condition.notify()
+        finally:
+            condition.release()
+
+    def storage(self, db_name, cache_size=0, cache_file=None, prefetch=0):
+        """Return a storage for the named database on a client taken
+        from the pool.  The client is given back when the storage is
+        closed.
+
+        The arguments are those of :meth:`Client.storage`.
+
+        :rtype: :class:`ClientStorage`
+        """
+        client = self.checkout()
+        try:
+            storage = client.storage(
+                db_name, cache_size, cache_file, prefetch)
+        except Exception:
+            self._drop(client)
+            raise
+        storage.on_close = lambda: self.checkin(client)
+        return storage
+
+    def disconnect(self):
+        """Disconnect idle clients, and the others as they are given
+        back."""
+        self.closed = True
+        condition = self.condition
+        condition.acquire()
+        try:
+            idle = self.idle
+            self.idle = []
+        finally:
+            condition.release()
+        for client, returned in idle:
+            self._drop(client)
+
+    def _is_connected(self, client, returned):
+        if client.reader is not None:
+            # The reader stops once the connection is lost.
+            return True
+        try:
+            # Nothing is due from the server while a client is idle, so
+            # a readable socket has been closed.
+            if select([client.socket], [], [], 0)[0]:
+                return False
+            if time() - returned > self.check_interval:
+                client.server_protocol()
+        except Exception:
+            return False
+        return True
+
+    def _close(self, client):
+        try:
+            client.disconnect()
+        except Exception:
+            # The connection is lost already.
+            if client.socket is not None:
+                client.socket.close()
+                client.socket = None
+
+    def _drop(self, client):
+        self._close(client)
+        self._forget()
+
+    def _forget(self):
+        # Let another client be connected in place of a dropped one.
+        condition = self.condition
+        condition.acquire()
+        try:
+            self.count -= 1
+            condition.notify()
+        finally:
+            condition.release()
+
+
+class SocketResponse(object):
+    """Reads a response directly from a socket."""
+
+    def __init__(self, socket):
+        self.socket = socket
+
+    def read(self, size):
+        return read(self.socket, size)
+
+    def read_int4(self):
+        return read_int4(self.socket)
+
+
+class FrameResponse(object):
+    """Reads a response received in a frame."""
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self, size):
+        start = self.position
+        self.position += size
+        if self.position > len(self.data):
+            raise ProtocolError('response is too short')
+        return self.data[start:self.position]
+
+    def read_int4(self):
+        return str_to_int4(self.read(4))
 
 
 class ClientStorage(Storage):
@@ -159,18 +681,86 @@ class ClientStorage(Storage):
     Please use :meth:`~Client.storage` to create
     storage instances, rather than creating instances of this class
     directly.
+
+    Records are cached in a :class:`~xdserver.cache.RecordCache` of
+    `cache_size` bytes, and cached records are dropped as the server
+    reports them invalid.  If `cache_file` is given, records are also
+    kept there when they are evicted or the storage is closed.  The
+    records in an existing file are checked with the server before
+    they are used.
+
+    If `prefetch` is given and the server supports it, loading a record
+    also fetches the records it refers to, up to :attr:`prefetch_depth`
+    references away and `prefetch` bytes in all, and caches them.  A
+    :class:`~durus.connection.Connection` walking a tree of objects then
+    finds the children of each node in the cache rather than loading
+    them one round trip at a time.
+
+    Before sending a transaction of :attr:`early_conflict_size` bytes or
+    more, the storage sends its oids, so that if another client has
+    committed one of them the commit fails without sending the rest.
     """
 
-    def __init__(self, client, db_name):
+    def __init__(self, client, db_name, cache_size=0, cache_file=None,
+                 session=0, prefetch=0):
         self.client = client
         self.db_name = int4_to_str(len(db_name)) + db_name
-        self.socket = client.socket
+        self.session = session
         self.oid_pool = []
-        self.oid_pool_size = 32
+        self.oid_pool_size = OID_POOL_MIN
+        self.oid_pool_filled = None
+        # Oids loaded or stored since they were last invalidated, all of
+        # which are invalid when the server asks for a resync.
+        self.loaded_oids = None
+        if client.protocol >= RESYNC_PROTOCOL:
+            self.loaded_oids = set()
+        # Responses pushed by the server once subscribed, and the oids
+        # taken from them that sync has yet to return.
+        self.subscribed = False
+        self.pushes = deque()
+        self.pushed = set()
+        # Prefetched records are only of use if they can be cached.
+        self.prefetch = 0
+        if cache_size and client.protocol >= PREFETCH_PROTOCOL:
+            self.prefetch = prefetch
+        self.prefetch_depth = PREFETCH_DEPTH
+        self.early_conflict_size = EARLY_CONFLICT_SIZE
+        # Prefetched oids whose references were not all sent with them.
+        self.frontier = set()
+        # Called once the storage is closed, if set.
+        self.on_close = None
+        spill = None
+        if cache_file is not None:
+            spill = anydbm.open(cache_file, 'c')
+        self.cache = RecordCache(cache_size, spill)
+        if spill is not None:
+            self._check_cache()
         self.begin()
 
-    def _get_load_response(self, oid):
-        status = read(self.socket, 1)
+    def _check_cache(self):
+        # Drop records in the cache file that changed on the server
+        # since the file was written.
+        spill = self.cache.spill
+        if self.client.server_protocol_max < FRAMED_PROTOCOL:
+            # The server cannot check records.
+            self.cache.clear()
+            return
+        oids = spill.keys()
+        for start in xrange(0, len(oids), CHECK_BATCH_SIZE):
+            batch = oids[start:start + CHECK_BATCH_SIZE]
+            items = []
+            for oid in batch:
+                items.append(oid)
+                items.append(record_digest(spill[oid]))
+            request_id = self._send_command(
+                'H', int4_to_str(len(batch)), join_bytes(items))
+            statuses = self.client._response(request_id).read(len(batch))
+            for oid, status in zip(batch, statuses):
+                if status != STATUS_OKAY:
+                    del spill[oid]
+
+    def _get_load_response(self, response, oid):
+        status = response.read(1)
         if status == STATUS_OKAY:
             pass
         elif status == STATUS_INVALID:
@@ -179,103 +769,319 @@ class ClientStorage(Storage):
             raise DurusKeyError(oid)
         else:
             raise ProtocolError('status=%r, oid=%r' % (status, oid))
-        n = read_int4(self.socket)
-        record = read(self.socket, n)
+        n = response.read_int4()
+        record = response.read(n)
         return record
 
-    def _send_command(self, command):
-        write_all(self.socket, command, self.db_name)
+    def _get_invalid_oids(self, response):
+        n = response.read_int4()
+        if n == RESYNC:
+            self.cache.clear()
+            return list(self.loaded_oids)
+        if n == 0:
+            packed_oids = ''
+        else:
+            packed_oids = response.read(8 * n)
+        oid_list = split_oids(packed_oids)
+        self.cache.invalidate(oid_list)
+        return oid_list
+
+    def _apply_pushes(self):
+        while self.pushes:
+            self.pushed.update(self._get_invalid_oids(self.pushes.popleft()))
+
+    def _take_pushed(self, oid_list):
+        # Return oid_list with the pushed oids sync has yet to return.
+        self._apply_pushes()
+        self.pushed.update(oid_list)
+        oid_list = self._loaded(self.pushed)
+        self.pushed.clear()
+        return oid_list
+
+    def _loaded(self, oids):
+        # Return a list of those of `oids` this storage has loaded, the
+        # only ones a connection can hold and need to invalidate.  Sets
+        # are intersected in bulk, so that a long list of invalid oids
+        # is not handed to the connection one by one.  The connection
+        # makes ghosts of those it is handed, so they are forgotten
+        # until they are loaded again; a resync forgets them all.
+        if self.loaded_oids is None:
+            return list(oids)
+        loaded = self.loaded_oids.intersection(oids)
+        self.loaded_oids.difference_update(loaded)
+        return list(loaded)
+
+    def _abandon_transaction(self):
+        # Return the oids allocated in the transaction to the pool and
+        # clear out its records.
+        self.transaction_new_oids.reverse()
+        self.oid_pool.extend(self.transaction_new_oids)
+        assert len(self.oid_pool) == len(set(self.oid_pool))
+        self.begin()
+
+    def _records_size(self):
+        # Bytes of the pending records, stopping once there are enough
+        # to send their oids ahead of them.
+        size = 0
+        for oid, record in iteritems(self.records):
+            size += 8 + len(record)
+            if size >= self.early_conflict_size:
+                break
+        return size
+
+    def _send_chunks(self, request_id):
+        # Send the transaction straight from self.records, in chunks of
+        # whole records of up to COMMIT_CHUNK_SIZE bytes, or of one
+        # larger record.
+        client = self.client
+        head = [int4_to_str(CHUNKED_COMMIT)]
+        parts = []
+        size = 0
+        for oid, record in iteritems(self.records):
+            rlen = 8 + len(record)
+            if parts and size + 4 + rlen > COMMIT_CHUNK_SIZE:
+                head.append(int4_to_str(size))
+                client._continue(request_id, *(head + parts))
+                head = []
+                parts = []
+                size = 0
+            parts.extend((int4_to_str(rlen), as_bytes(oid), record))
+            size += 4 + rlen
+        head.append(int4_to_str(size))
+        parts.append(int4_to_str(0))
+        client._continue(request_id, *(head + parts))
+
+    def _send_command(self, command, *parts):
+        return self.client._session_request(
+            self.session, command, self.db_name, *parts)
 
     def begin(self):
         self.records = {}
         self.transaction_new_oids = []
 
     def bulk_load(self, oids):
-        oid_str = join_bytes(oids)
-        num_oids, remainder = divmod(len(oid_str), 8)
-        assert remainder == 0, remainder
-        self._send_command('B')
-        write_all(self.socket, int4_to_str(num_oids), oid_str)
-        records = [self._get_load_response(oid) for oid in oids]
-        for record in records:
-            yield record
+        oids = list(oids)
+        if self.subscribed:
+            self._apply_pushes()
+            for oid in oids:
+                if oid in self.pushed:
+                    raise ReadConflictError([oid])
+        cache = self.cache
+        records = {}
+        missing = []
+        for oid in oids:
+            record = cache.get(oid)
+            if record is None:
+                missing.append(oid)
+            else:
+                records[oid] = record
+        if missing:
+            oid_str = join_bytes(missing)
+            num_oids, remainder = divmod(len(oid_str), 8)
+            assert remainder == 0, remainder
+            request_id = self._send_command(
+                'B', int4_to_str(num_oids), oid_str)
+            response = self.client._response(request_id)
+            # Read every response before raising, so that the next
+            # command does not read what is left of this one.
+            error = None
+            for oid in missing:
+                try:
+                    record = self._get_load_response(response, oid)
+                except (DurusKeyError, ReadConflictError), e:
+                    if error is None:
+                        error = e
+                else:
+                    records[oid] = record
+                    cache.put(oid, record)
+            if error is not None:
+                raise error
+        if self.loaded_oids is not None:
+            self.loaded_oids.update(oids)
+        for oid in oids:
+            yield records[oid]
 
     def close(self):
         # No-op on server side, but destroys this instance so that
         # it conforms to API.
-        self.socket = None
+        self.cache.close()
+        self.client.subscribers.pop(self.session, None)
+        if self.session:
+            # End the session on the server.
+            self.client._session_request(self.session, '.')
+        self.client = None
+        if self.on_close is not None:
+            self.on_close()
 
     def end(self, handle_invalidations=None):
-        self._send_command('C')
-        n = read_int4(self.socket)
-        oid_list = []
-        if n != 0:
-            packed_oids = read(self.socket, 8 * n)
-            oid_list = split_oids(packed_oids)
+        request_id = self._send_command('C')
+        response = self.client._response(request_id)
+        oid_list = self._get_invalid_oids(response)
+        if self.subscribed:
+            oid_list = self._take_pushed(oid_list)
+        else:
+            oid_list = self._loaded(oid_list)
+        if oid_list:
             try:
                 handle_invalidations(oid_list)
             except ConflictError:
-                self.transaction_new_oids.reverse()
-                self.oid_pool.extend(self.transaction_new_oids)
-                assert len(self.oid_pool) == len(set(self.oid_pool))
-                self.begin() # clear out records and transaction_new_oids
-                write_int4(self.socket, 0)
+                self._abandon_transaction()
+                self.client._continue(request_id, int4_to_str(0))
                 raise
-        tdata = []
-        for oid, record in iteritems(self.records):
-            tdata.append(int4_to_str(8 + len(record)))
-            tdata.append(as_bytes(oid))
-            tdata.append(record)
-        tdata = join_bytes(tdata)
-        write_int4_str(self.socket, tdata)
-        self.records.clear()
-        if len(tdata) > 0:
-            status = read(self.socket, 1)
+        if (self.records and
+            self.client.protocol >= EARLY_CONFLICT_PROTOCOL and
+            self._records_size() >= self.early_conflict_size):
+            self.client._continue(
+                request_id, int4_to_str(WRITE_SET),
+                int4_to_str(len(self.records)),
+                join_bytes(self.records.keys()))
+            if self.client._response(request_id).read(1) != STATUS_OKAY:
+                self._abandon_transaction()
+                raise WriteConflictError()
+        if self.records and self.client.protocol >= CHUNKED_COMMIT_PROTOCOL:
+            self._send_chunks(request_id)
+        else:
+            tdata = []
+            for oid, record in iteritems(self.records):
+                tdata.append(int4_to_str(8 + len(record)))
+                tdata.append(as_bytes(oid))
+                tdata.append(record)
+            tdata = join_bytes(tdata)
+            self.client._continue(request_id, int4_to_str(len(tdata)), tdata)
+        records = self.records
+        self.records = {}
+        if records:
+            status = self.client._response(request_id).read(1)
             if status == STATUS_OKAY:
-                pass
+                for oid, record in iteritems(records):
+                    self.cache.put(oid, record)
+                if self.loaded_oids is not None:
+                    self.loaded_oids.update(records)
             elif status == STATUS_INVALID:
                 raise WriteConflictError()
+            elif status == STATUS_TOO_LARGE:
+                raise CommitSizeError(
+                    'commit larger than the server accepts')
             else:
                 raise ProtocolError(
                     'server returned invalid status %r' % status)
 
     def load(self, oid):
-        self._send_command('L')
-        write(self.socket, oid)
-        return self._get_load_response(oid)
+        if self.subscribed:
+            self._apply_pushes()
+            if oid in self.pushed:
+                raise ReadConflictError([oid])
+        record = self.cache.get(oid)
+        if self.prefetch and (record is None or oid in self.frontier):
+            # Prefetch again from a prefetched record whose references
+            # were not all sent, so that walking on from it does not
+            # load them one at a time.
+            self.frontier.discard(oid)
+            try:
+                record = self._prefetch(oid)
+            except (DurusKeyError, ReadConflictError):
+                if record is None:
+                    raise
+        elif record is None:
+            request_id = self._send_command('L', oid)
+            response = self.client._response(request_id)
+            record = self._get_load_response(response, oid)
+            self.cache.put(oid, record)
+        if self.loaded_oids is not None:
+            self.loaded_oids.add(oid)
+        return record
+
+    def _prefetch(self, oid):
+        # Load oid with the 'K' command, and cache the records sent
+        # along with it.
+        request_id = self._send_command(
+            'K', oid, int4_to_str(self.prefetch_depth),
+            int4_to_str(self.prefetch))
+        response = self.client._response(request_id)
+        try:
+            record = self._get_load_response(response, oid)
+        finally:
+            # Read the records sent along, if any, even after an error,
+            # so that the next command does not read them.
+            prefetched = [
+                response.read(response.read_int4())
+                for n in xrange(response.read_int4())]
+        cache = self.cache
+        cache.put(oid, record)
+        for each in prefetched:
+            cache.put(each[:8], each)
+        for each in prefetched:
+            for ref in split_oids(unpack_record(each)[2]):
+                if ref not in cache:
+                    self.frontier.add(each[:8])
+                    break
+        return record
+
+    def _fill_oid_pool(self):
+        now = time()
+        if self.oid_pool_filled is not None:
+            if now - self.oid_pool_filled < OID_POOL_INTERVAL:
+                self.oid_pool_size = min(2 * self.oid_pool_size, OID_POOL_MAX)
+            else:
+                self.oid_pool_size = max(self.oid_pool_size // 2, OID_POOL_MIN)
+        self.oid_pool_filled = now
+        if self.client.server_protocol_max >= OID_RANGES_PROTOCOL:
+            request_id = self._send_command(
+                'R', int4_to_str(self.oid_pool_size))
+            response = self.client._response(request_id)
+            count = response.read_int4()
+            self.oid_pool = unpack_oid_ranges(response.read(12 * count))
+        else:
+            batch = min(self.oid_pool_size, 255)
+            request_id = self._send_command('M', chr(batch))
+            response = self.client._response(request_id)
+            self.oid_pool = split_oids(response.read(8 * batch))
+        self.oid_pool.reverse()
+        assert len(self.oid_pool) == len(set(self.oid_pool))
 
     def new_oid(self):
         if not self.oid_pool:
-            batch = self.oid_pool_size
-            self._send_command('M')
-            write(self.socket, chr(batch))
-            self.oid_pool = split_oids(read(self.socket, 8 * batch))
-            self.oid_pool.reverse()
-            assert len(self.oid_pool) == len(set(self.oid_pool))
+            self._fill_oid_pool()
         oid = self.oid_pool.pop()
-        assert oid not in self.oid_pool
         self.transaction_new_oids.append(oid)
         return oid
 
     def pack(self):
-        self._send_command('P')
-        status = read(self.socket, 1)
+        request_id = self._send_command('P')
+        status = self.client._response(request_id).read(1)
         if status != STATUS_OKAY:
             raise ProtocolError('server returned invalid status %r' % status)
 
+    def subscribe(self):
+        """Have the server push invalidations to this storage as other
+        clients commit, so that :meth:`sync` does not need to ask.
+
+        :return: False if the server or connection does not support it.
+        :rtype: boolean
+        """
+        client = self.client
+        if client.protocol < PUSH_PROTOCOL or not self.session:
+            return False
+        client.subscribers[self.session] = self
+        request_id = self._send_command('W')
+        if client._response(request_id).read(1) != STATUS_OKAY:
+            del client.subscribers[self.session]
+            return False
+        client._start_reader()
+        self.subscribed = True
+        return True
+
     def store(self, oid, record):
         assert len(oid) == 8
         assert oid not in self.records
         self.records[oid] = record
 
     def sync(self):
-        self._send_command('S')
-        n = read_int4(self.socket)
-        if n == 0:
-            packed_oids = ''
-        else:
-            packed_oids = read(self.socket, 8 * n)
-        return split_oids(packed_oids)
+        if self.subscribed:
+            return self._take_pushed([])
+        request_id = self._send_command('S')
+        return self._loaded(
+            self._get_invalid_oids(self.client._response(request_id)))
 
 
 def main():
@@ -0,0 +1,92 @@
+__all__ = [
+    'StorageExecutor',
+    ]
+
+from collections import deque
+from Queue import Queue
+import sys
+from threading import Lock, Thread
+
+
+class Job(object):
+    """A call submitted to a :class:`StorageExecutor`."""
+
+    def __init__(self, key, func, args):
+        self.key = key
+        self.func = func
+        self.args = args
+        self.result = None
+        self.exc_info = None
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception:
+            self.exc_info = sys.exc_info()
+
+
+class StorageExecutor(object):
+    """Runs blocking storage calls on a bounded pool of worker threads.
+
+    Jobs that share a key, normally a database name, run one at a time
+    in the order they were submitted, so a storage is never used by two
+    threads at once.  Jobs with different keys run concurrently.
+
+    :param workers: Number of worker threads.
+    :type workers: integer
+    :param notify: Called from a worker thread with each finished job.
+    """
+
+    def __init__(self, workers, notify):
+        self.notify = notify
+        self.lock = Lock()
+        # Key -> jobs waiting behind the one that is running.  A key is
+        # present only while one of its jobs is running or ready.
+        self.waiting = {}
+        self.ready = Queue()
+        self.threads = []
+        for number in xrange(workers):
+            thread = Thread(
+                target=self._work, name='xdserver-worker-%i' % number)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, key, func, *args):
+        """Schedule ``func(*args)`` and return its :class:`Job`."""
+        job = Job(key, func, args)
+        self.lock.acquire()
+        try:
+            if key in self.waiting:
+                self.waiting[key].append(job)
+                return job
+            self.waiting[key] = deque()
+        finally:
+            self.lock.release()
+        self.ready.put(job)
+        return job
+
+    def shutdown(self):
+        """Stop worker threads after the jobs that are ready to run."""
+        for thread in self.threads:
+            self.ready.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _work(self):
+        while 1:
+            job = self.ready.get()
+            if job is None:
+                break
+            job.run()
+            self.lock.acquire()
+            try:
+                waiting = self.waiting[job.key]
+                if waiting:
+                    self.ready.put(waiting.popleft())
+                else:
+                    del self.waiting[job.key]
+            finally:
+                self.lock.release()
+            self.notify(job)
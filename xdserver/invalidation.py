@@ -0,0 +1,84 @@
+__all__ = [
+    'InvalidationLog',
+    ]
+
+from collections import deque
+from itertools import islice, izip, repeat
+
+
+class InvalidationLog(object):
+    """Append-only log of the oids invalidated in one database.
+
+    Each client keeps a cursor, the position of the first entry it has
+    not been sent.  Entries are batches of oids, each tagged with the
+    client whose commit produced it, if any, so that clients are not
+    sent their own commits.
+
+    :param max_oids: Number of oids in the log above which the server
+      should compact it.
+    :type max_oids: integer
+    """
+
+    def __init__(self, max_oids):
+        self.max_oids = max_oids
+        # Position of the first entry still in the log.
+        self.start = 0
+        self.entries = deque()
+        self.oids = 0
+        # oid -> (position, source) of the latest entry holding it.
+        self.positions = {}
+
+    def __contains__(self, oid):
+        return oid in self.positions
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def end(self):
+        """Position the next entry will be appended at."""
+        return self.start + len(self.entries)
+
+    def append(self, oids, source=None):
+        """Append an entry of `oids`, invalidated by `source`."""
+        position = self.end
+        self.entries.append((oids, source))
+        self.oids += len(oids)
+        self.positions.update(izip(oids, repeat((position, source))))
+
+    def is_invalid(self, oid, cursor, reader):
+        """Return True if `oid` was invalidated at or after `cursor` by
+        a source other than `reader`."""
+        if cursor < self.start:
+            return True
+        position = self.positions.get(oid)
+        return (position is not None and position[0] >= cursor
+                and position[1] is not reader)
+
+    def since(self, cursor, reader):
+        """Return the set of oids invalidated at or after `cursor` by
+        sources other than `reader`.
+
+        `cursor` must not be before :attr:`start`.
+        """
+        result = set()
+        for oids, source in islice(self.entries, cursor - self.start, None):
+            if source is not reader:
+                result.update(oids)
+        return result
+
+    def compact(self, cursor):
+        """Drop the entries before `cursor` and return them."""
+        dropped = []
+        positions = self.positions
+        while self.start < cursor and self.entries:
+            oids, source = self.entries.popleft()
+            for oid in oids:
+                # An entry may hold an oid more than once.
+                position = positions.get(oid)
+                if position is not None and position[0] == self.start:
+                    del positions[oid]
+            self.oids -= len(oids)
+            self.start += 1
+            dropped.append((oids, source))
+        return dropped
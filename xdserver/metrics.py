@@ -0,0 +1,211 @@
+__all__ = [
+    'Histogram',
+    'Metrics',
+    ]
+
+from bisect import bisect_left
+from time import time
+
+
+# Upper bounds of the buckets of command latencies, in seconds.
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Upper bounds of the buckets of commit sizes, in bytes: 1KB to 1GB.
+SIZE_BUCKETS = tuple(1 << n for n in xrange(10, 31, 2))
+
+
+class Histogram(object):
+    """Counts of observed values in buckets with fixed upper bounds.
+
+    :param bounds: Increasing upper bounds of the buckets.  Values above
+      the last fall in a bucket of their own.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        """Count `value` in its bucket."""
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        """Return lines of text for the histogram as `name`, with
+        cumulative buckets as in the Prometheus text format."""
+        lines = []
+        total = 0
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            total += count
+            lines.append('%s_bucket%s %s' % (
+                name, _labels(labels + (('le', bound),)), total))
+        lines.append('%s_sum%s %s' % (name, _labels(labels), self.sum))
+        lines.append('%s_count%s %s' % (name, _labels(labels), self.count))
+        return lines
+
+
+class CommandStats(object):
+    """Totals for one command on one database."""
+
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.errors = 0
+        self.received = 0
+        self.sent = 0
+
+
+class Metrics(object):
+    """Totals of the requests a server has handled since it started.
+
+    :meth:`render` reports them in the Prometheus text format, along
+    with the state of the server's open databases and clients.
+    """
+
+    def __init__(self):
+        self.started = time()
+        # (command, database name or '') -> CommandStats.
+        self.commands = {}
+        # Database name -> histogram of committed bytes, and counts of
+        # conflicts, refused commits and finished packs.
+        self.commits = {}
+        self.conflicts = {}
+        self.refused = {}
+        self.packs = {}
+
+    def command(self, command, db_name, seconds, received=0, sent=0,
+                failed=False):
+        """Count a handled command.
+
+        :param command: Name of the command's handler, without its
+          ``handle_`` prefix.
+        :param db_name: Name of the database, or '' for a command that
+          does not have one.
+        :param seconds: Time taken to handle the command.
+        :param received: Bytes of the request.
+        :param sent: Bytes of the response.
+        :param failed: True if the handler raised an error.
+        """
+        key = (command, db_name)
+        stats = self.commands.get(key)
+        if stats is None:
+            stats = self.commands[key] = CommandStats()
+        stats.latency.observe(seconds)
+        stats.received += received
+        stats.sent += sent
+        if failed:
+            stats.errors += 1
+
+    def commit(self, db_name, size):
+        """Count a commit of `size` bytes."""
+        histogram = self.commits.get(db_name)
+        if histogram is None:
+            histogram = self.commits[db_name] = Histogram(SIZE_BUCKETS)
+        histogram.observe(size)
+
+    def conflict(self, db_name):
+        """Count a commit refused because of a conflict."""
+        self.conflicts[db_name] = self.conflicts.get(db_name, 0) + 1
+
+    def refuse(self, db_name):
+        """Count a commit refused for its size."""
+        self.refused[db_name] = self.refused.get(db_name, 0) + 1
+
+    def pack(self, db_name):
+        """Count a finished pack."""
+        self.packs[db_name] = self.packs.get(db_name, 0) + 1
+
+    def render(self, server):
+        """Return the metrics of `server` as text."""
+        lines = [
+            '# TYPE xdserver_uptime_seconds gauge',
+            'xdserver_uptime_seconds %s' % (time() - self.started),
+            '# TYPE xdserver_clients gauge',
+            'xdserver_clients %s' % len(server.clients),
+            '# TYPE xdserver_open_databases gauge',
+            'xdserver_open_databases %s' % len(server.storages),
+            '# TYPE xdserver_idle_databases gauge',
+            'xdserver_idle_databases %s' % len(server.idle),
+            ]
+        lines.append('# TYPE xdserver_command_seconds histogram')
+        for (command, db_name), stats in sorted(self.commands.items()):
+            lines.extend(stats.latency.lines(
+                'xdserver_command_seconds',
+                (('command', command), ('database', db_name))))
+        for name, attribute in [
+            ('xdserver_command_errors_total', 'errors'),
+            ('xdserver_command_received_bytes_total', 'received'),
+            ('xdserver_command_sent_bytes_total', 'sent'),
+            ]:
+            lines.append('# TYPE %s counter' % name)
+            for (command, db_name), stats in sorted(self.commands.items()):
+                lines.append('%s%s %s' % (
+                    name,
+                    _labels((('command', command), ('database', db_name))),
+                    getattr(stats, attribute)))
+        lines.append('# TYPE xdserver_commit_bytes histogram')
+        for db_name, histogram in sorted(self.commits.items()):
+            lines.extend(histogram.lines(
+                'xdserver_commit_bytes', (('database', db_name),)))
+        for name, counts in [
+            ('xdserver_conflicts_total', self.conflicts),
+            ('xdserver_refused_commits_total', self.refused),
+            ('xdserver_packs_total', self.packs),
+            ]:
+            lines.append('# TYPE %s counter' % name)
+            for db_name, count in sorted(counts.items()):
+                lines.append('%s%s %s' % (
+                    name, _labels((('database', db_name),)), count))
+        storages = sorted(server.storages.items())
+        for name, value in [
+            ('xdserver_packing',
+             lambda storage: int(storage.d_packer is not None)),
+            ('xdserver_pack_steps', lambda storage: storage.d_pack_steps),
+            ('xdserver_bytes_since_pack',
+             lambda storage: storage.d_bytes_since_pack),
+            ('xdserver_log_oids', lambda storage: storage.d_log.oids),
+            ('xdserver_cache_bytes', lambda storage: storage.d_cache.bytes),
+            ('xdserver_cache_hits', lambda storage: storage.d_cache.hits),
+            ('xdserver_cache_misses',
+             lambda storage: storage.d_cache.misses),
+            ]:
+            lines.append('# TYPE %s gauge' % name)
+            for db_name, storage in storages:
+                lines.append('%s%s %s' % (
+                    name, _labels((('database', db_name),)), value(storage)))
+        # Oids each client has yet to be sent: those held for it, and
+        # the log entries after its cursor.
+        invalid_lines = ['# TYPE xdserver_client_invalid_oids gauge']
+        behind_lines = ['# TYPE xdserver_client_log_entries_behind gauge']
+        for client in sorted(server.clients, key=_client_name):
+            for db_name, storage in storages:
+                labels = _labels(
+                    (('client', _client_name(client)), ('database', db_name)))
+                invalid_lines.append('xdserver_client_invalid_oids%s %s' % (
+                    labels, len(client.invalid[db_name])))
+                behind_lines.append(
+                    'xdserver_client_log_entries_behind%s %s' % (
+                        labels,
+                        max(0, storage.d_log.end - client.cursors[db_name])))
+        lines.extend(invalid_lines)
+        lines.extend(behind_lines)
+        lines.append('')
+        return '\n'.join(lines)
+
+
+def _client_name(client):
+    # The client's address, and its session number on that connection.
+    return '%s#%s' % (client.connection.address, client.number)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for name, value in labels)
@@ -0,0 +1,116 @@
+__all__ = [
+    'OidSet',
+    ]
+
+from bisect import bisect_right
+from heapq import merge
+from itertools import izip
+
+from durus.utils import int8_to_str, str_to_int8
+
+
+class OidSet(object):
+    """Set of oids held as sorted, disjoint ranges of integers.
+
+    Oids allocated together are consecutive, so the oids a client has
+    been allocated but has yet to commit take a few ranges rather than
+    a string each.  Iterating yields the oids as 8-byte strings.
+
+    :param oids: Oids to add, as 8-byte strings or another
+      :class:`OidSet`.
+    """
+
+    def __init__(self, oids=()):
+        # Range i holds the integers from starts[i] up to, but not
+        # including, ends[i].
+        self.starts = []
+        self.ends = []
+        self.count = 0
+        if oids:
+            self.update(oids)
+
+    def __contains__(self, oid):
+        n = str_to_int8(oid)
+        i = bisect_right(self.starts, n) - 1
+        return i >= 0 and n < self.ends[i]
+
+    def __iter__(self):
+        for start, end in izip(self.starts, self.ends):
+            for n in xrange(start, end):
+                yield int8_to_str(n)
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return '<%s of %s oids in %s ranges>' % (
+            self.__class__.__name__, self.count, len(self.starts))
+
+    def clear(self):
+        """Remove all oids."""
+        self.starts = []
+        self.ends = []
+        self.count = 0
+
+    def update(self, oids):
+        """Add all of `oids`."""
+        ranges = []
+        for start, end in merge(self._ranges(), _ranges(oids)):
+            if ranges and start <= ranges[-1][1]:
+                if end > ranges[-1][1]:
+                    ranges[-1][1] = end
+            else:
+                ranges.append([start, end])
+        self._set_ranges(ranges)
+
+    def difference_update(self, oids):
+        """Remove all of `oids` that are present."""
+        removed = _ranges(oids)
+        ranges = []
+        j = 0
+        for start, end in self._ranges():
+            while j < len(removed) and removed[j][1] <= start:
+                j += 1
+            k = j
+            while k < len(removed) and removed[k][0] < end:
+                if removed[k][0] > start:
+                    ranges.append((start, removed[k][0]))
+                start = max(start, removed[k][1])
+                k += 1
+            if start < end:
+                ranges.append((start, end))
+        self._set_ranges(ranges)
+
+    def isdisjoint(self, oids):
+        """Return True if none of `oids` is present."""
+        ranges = self._ranges()
+        i = 0
+        for start, end in _ranges(oids):
+            while i < len(ranges) and ranges[i][1] <= start:
+                i += 1
+            if i == len(ranges):
+                break
+            if ranges[i][0] < end:
+                return False
+        return True
+
+    def _ranges(self):
+        return zip(self.starts, self.ends)
+
+    def _set_ranges(self, ranges):
+        self.starts = [start for start, end in ranges]
+        self.ends = [end for start, end in ranges]
+        self.count = sum(self.ends) - sum(self.starts)
+
+
+def _ranges(oids):
+    # Return a sorted list of disjoint (start, end) ranges holding oids.
+    if isinstance(oids, OidSet):
+        return oids._ranges()
+    ranges = []
+    for n in sorted(str_to_int8(oid) for oid in oids):
+        if ranges and n <= ranges[-1][1]:
+            ranges[-1][1] = n + 1
+        else:
+            ranges.append([n, n + 1])
+    return [(start, end) for start, end in ranges]
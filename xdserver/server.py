@@ -2,20 +2,27 @@ __all__ = [
     'Server',
     ]
 
+from collections import deque
+from ConfigParser import RawConfigParser
 from datetime import datetime
+from hashlib import md5
 import os
+from socket import SHUT_RDWR, create_connection, error as socket_error
+from struct import unpack_from
 import sys
+from time import time
+from traceback import format_exc
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, SUPPRESS
 
 from cogen.core.coroutines import coro
+from cogen.core.events import Signal, Sleep, WaitForSignal
 from cogen.core.schedulers import Scheduler
 from cogen.core.sockets import ConnectionClosed, Socket, SocketError
 
-from durus.error import ConflictError
+from durus.error import ConflictError, ReadConflictError
 from durus.logger import log, logger, is_logging
-from durus.file_storage import FileStorage
-from durus.serialize import extract_class_name, split_oids
+from durus.serialize import extract_class_name, split_oids, unpack_record
 from durus.storage_server import (
     DEFAULT_GCBYTES,
     STATUS_OKAY, STATUS_KEYERROR, STATUS_INVALID,
@@ -26,14 +33,129 @@ from durus.utils import (
     join_bytes,
     )
 
+from xdserver.cache import RecordCache
+from xdserver.executor import StorageExecutor
+from xdserver.invalidation import InvalidationLog
+from xdserver.metrics import Metrics
+from xdserver.oidset import OidSet
+from xdserver.snapshot import SNAPSHOT_SUFFIX, SnapshotFileStorage
+from xdserver.supervisor import Supervisor
+
 
 DEFAULT_HOST = '127.0.0.1'
 DEFAULT_PORT = 22972
 
+# Protocol answered by 'V', spoken by every client when it connects.
 PROTOCOL = int4_to_str(20001)
 
+# From this version on, a client may switch to sending requests and
+# receiving responses in frames tagged with request ids.  It also adds
+# the 'H' command.
+FRAMED_PROTOCOL = 20002
+
+# Adds the 'R' command, which allocates oids in ranges.
+OID_RANGES_PROTOCOL = 20003
+
+# Clients that fall too far behind the invalidation log are sent RESYNC
+# in place of a count of invalid oids, and must treat all oids as
+# invalid.
+RESYNC_PROTOCOL = 20004
+RESYNC = 0xFFFFFFFF
+
+# Adds the 'W' command, which subscribes a session to invalidations
+# pushed in frames with request id 0.
+PUSH_PROTOCOL = 20005
+
+# A client may send CHUNKED_COMMIT in place of a transaction's length,
+# followed by chunks of whole records, each preceded by its length, and
+# a zero length.  Commits over the server's size limit are answered
+# with STATUS_TOO_LARGE.
+CHUNKED_COMMIT_PROTOCOL = 20006
+CHUNKED_COMMIT = 0xFFFFFFFF
+STATUS_TOO_LARGE = 'T'
+
+# Adds the 'G' command, which answers the port of the server process
+# that owns a database, or an empty string if it is served here.  The
+# processes share a host, which clients already know; the host the
+# server binds to, such as 0.0.0.0, may not be reachable as it is.
+ROUTE_PROTOCOL = 20007
+
+# Adds the 'K' command, which loads a record and also sends the records
+# it refers to, up to a number of references away and a total length.
+PREFETCH_PROTOCOL = 20008
+
+# Adds the 'I' command, which answers the server's metrics as text.
+METRICS_PROTOCOL = 20009
+
+# A client may send WRITE_SET in place of a transaction's length,
+# followed by a count of oids and the oids it will store.  The server
+# answers STATUS_INVALID if they conflict, ending the commit before the
+# transaction is sent; otherwise it invalidates them for other clients
+# and answers STATUS_OKAY, and the client goes on to send the
+# transaction's length.
+EARLY_CONFLICT_PROTOCOL = 20010
+WRITE_SET = 0xFFFFFFFE
+
+# Newest protocol answered by 'U'.
+MAX_PROTOCOL = EARLY_CONFLICT_PROTOCOL
+
+# Most oids allocated by one 'R' command.
+MAX_NEW_OIDS = 1 << 20
+
+# Most bytes of records sent along with one 'K' command, and the number
+# of records loaded at a time to find them, so that loading stops soon
+# after that many bytes have been found.
+MAX_PREFETCH_BYTES = 1 << 22
+PREFETCH_BATCH_SIZE = 256
+
 EXTENSION = '.durus'
 
+# Bytes of records to cache for each open database.
+DEFAULT_CACHE_SIZE = 0
+
+# Oids to keep in the invalidation log of each open database.
+DEFAULT_LOG_SIZE = 100000
+
+# Bytes of a transaction read from a client at a time when committing.
+COMMIT_CHUNK_SIZE = 1 << 20
+
+# Largest transaction to accept, in bytes; 0 accepts any.
+DEFAULT_MAX_COMMIT_SIZE = 0
+
+# Seconds to gather commits to a database before storing them as one
+# transaction; 0 stores each commit on its own.
+DEFAULT_GROUP_COMMIT = 0
+
+# Most databases to keep open, and seconds a database may go unused
+# before it is closed; 0 sets no limit.  Closed databases reopen on
+# their next request.
+DEFAULT_MAX_OPEN = 0
+DEFAULT_IDLE_CLOSE = 0
+
+# Attributes of an open storage kept while it is closed for being
+# idle: those clients' cursors and oids depend on.
+IDLE_STATE = ['d_log', 'd_reserved', 'd_subscribers', 'd_bytes_since_pack']
+
+# Seconds to gather invalidations before pushing them to subscribers.
+DEFAULT_PUSH_INTERVAL = 0.05
+
+# Seconds spent advancing an iterative pack before yielding to clients.
+# The server pauses as long between slices, so that a pack takes at most
+# half the time of its database, and a request waits for at most one
+# slice.
+DEFAULT_PACK_SLICE = 0.005
+
+# Shortest pause between pack slices, as cogen never resumes a Sleep of
+# no time.
+PACK_PAUSE = 0.001
+
+# Packer of a storage whose packer is being made, so that no other pack
+# is started meanwhile.
+PACK_STARTING = object()
+
+# Longest line of an HTTP request for metrics that is read whole.
+MAX_SCRAPE_LINE = 8192
+
 
 def database_names(path):
     """Return a list of all Durus database names in a given path."""
@@ -43,14 +165,64 @@ def database_names(path):
             yield name
 
 
+def record_digest(record):
+    """Return the 16-byte digest used to check a cached record."""
+    return md5(record).digest()
+
+
+def pack_oid_ranges(oids):
+    """Return `oids` packed as a count of ranges of consecutive oids,
+    each a first oid and a length."""
+    ranges = []
+    for oid in oids:
+        n = str_to_int8(oid)
+        if ranges and n == ranges[-1][0] + ranges[-1][1]:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([n, 1])
+    return int4_to_str(len(ranges)) + join_bytes(
+        int8_to_str(first) + int4_to_str(length) for first, length in ranges)
+
+
+def unpack_oid_ranges(data):
+    """Return the list of oids in ranges packed by `pack_oid_ranges`,
+    without the count."""
+    oids = []
+    for i in xrange(0, len(data), 12):
+        first = str_to_int8(data[i:i+8])
+        length = str_to_int4(data[i+8:i+12])
+        oids.extend(int8_to_str(n) for n in xrange(first, first + length))
+    return oids
+
+
 class ConnectedClient(object):
 
     def __init__(self, client_socket):
-        f = self.f = client_socket.makefile()
+        # Bytes of the request being handled read and of its response
+        # written, when not framed.
+        self.received = 0
+        self.sent = 0
+        self._open(client_socket)
+        self.connection = self
+        self.session = self
+        self.number = 0
+        self.protocol = str_to_int4(PROTOCOL)
+        self.cursors = {}
         self.invalid = {}
         self.unused_oids = {}
-        self.read = f.read
-        self.write = f.write
+        # Framed protocol state: frames waiting to be written, requests
+        # being handled by id, requests waiting by session and database
+        # name, and sessions by number.
+        self.disconnected = False
+        self.outbox = deque()
+        self.requests = {}
+        self.queues = {}
+        self.sessions = {0: self}
+
+    def _open(self, client_socket):
+        self.address = '%s:%s' % client_socket.getpeername()[:2]
+        self.socket = client_socket
+        f = self.f = client_socket.makefile()
         self.flush = f.flush
         self.close = f.close
 
@@ -58,6 +230,130 @@ class ConnectedClient(object):
     def closed(self):
         return self.f.closed
 
+    def read(self, size):
+        self.received += size
+        return self.f.read(size)
+
+    def write(self, data):
+        self.sent += len(data)
+        return self.f.write(data)
+
+    def reset(self):
+        """Shut the connection down, so that pending and later reads
+        from it fail."""
+        try:
+            self.socket.shutdown(SHUT_RDWR)
+        except socket_error:
+            pass
+
+
+class Session(object):
+    """Per-storage state of one of the sessions on a framed connection.
+
+    Each :class:`~xdserver.client.ClientStorage` sharing a connection
+    uses its own session, so that it is sent the oids committed by the
+    others just as if it had a connection of its own.
+    """
+
+    def __init__(self, connection, number, storages):
+        self.connection = connection
+        self.session = self
+        self.number = number
+        self.cursors = dict(
+            (db_name, storage.d_log.end)
+            for db_name, storage in storages.items())
+        self.invalid = dict((db_name, OidSet()) for db_name in storages)
+        self.unused_oids = dict((db_name, OidSet()) for db_name in storages)
+
+
+class FramedRequest(object):
+    """A request received from a client in a frame.
+
+    Handlers read the request and write its response through this object
+    as they would through a :class:`ConnectedClient`.  Other attributes
+    are those of the session the request was made in.
+    """
+
+    def __init__(self, session, request_id, data):
+        self.session = session
+        self.connection = session.connection
+        self.request_id = request_id
+        # Frames of the request not yet read, from `offset` in the first.
+        self.frames = deque([data])
+        self.offset = 0
+        self.unread = len(data)
+        self.output = []
+        # Bytes of the request received and of the response flushed.
+        self.received = len(data)
+        self.sent = 0
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def receive(self, data):
+        """Add a further frame of the request."""
+        self.frames.append(data)
+        self.unread += len(data)
+        self.received += len(data)
+
+    @coro
+    def read(self, size):
+        # Wait for further frames with this request's id if the request
+        # has to be answered before the client sends the rest of it.
+        while self.unread < size:
+            if self.connection.disconnected:
+                raise ConnectionClosed('Connection closed.')
+            yield WaitForSignal(self)
+        self.unread -= size
+        frames = self.frames
+        pieces = []
+        while size:
+            frame = frames[0]
+            start = self.offset
+            end = min(start + size, len(frame))
+            if start == 0 and end == len(frame):
+                pieces.append(frame)
+            else:
+                pieces.append(frame[start:end])
+            size -= end - start
+            if end == len(frame):
+                frames.popleft()
+                self.offset = 0
+            else:
+                self.offset = end
+        if len(pieces) == 1:
+            raise StopIteration(pieces[0])
+        raise StopIteration(join_bytes(pieces))
+
+    @coro
+    def write(self, data):
+        self.output.append(data)
+
+    @coro
+    def flush(self):
+        if self.output:
+            data = join_bytes(self.output)
+            self.output = []
+            self.sent += len(data)
+            connection = self.connection
+            connection.outbox.append(join_bytes([
+                int4_to_str(self.request_id), int4_to_str(len(data)), data]))
+            yield Signal((connection, 'outbox'))
+
+
+class CommitBatch(object):
+    """Transactions gathered to be stored together by group commit.
+
+    Once stored, :attr:`results` holds the ``(invalidations, exc_info)``
+    of each transaction, and the batch is signalled.
+    """
+
+    def __init__(self):
+        self.transactions = []
+        # Oids the transactions store.
+        self.oids = set()
+        self.results = None
+
 
 class Server(object):
     """Provides access to databases for xdserver clients.
@@ -69,7 +365,10 @@ class Server(object):
     handlers = {
         'A': 'handle_enumerate_all',
         'E': 'handle_enumerate_open',
+        'F': 'handle_set_protocol',
+        'I': 'handle_metrics',
         'Q': 'handle_quit',
+        'U': 'handle_max_protocol',
         'V': 'handle_version',
         '.': 'handle_disconnect',
     }
@@ -78,25 +377,72 @@ class Server(object):
         'B': 'handle_bulk_read',
         'C': 'handle_commit',
         'D': 'handle_destroy',
+        'G': 'handle_route',
+        'H': 'handle_check_records',
+        'K': 'handle_prefetch',
         'L': 'handle_load',
         'M': 'handle_new_oids',
         'N': 'handle_new_oid',
         'O': 'handle_open',
         'P': 'handle_pack',
+        'R': 'handle_new_oid_ranges',
         'S': 'handle_sync',
+        'W': 'handle_subscribe',
         'X': 'handle_close',
     }
 
-    def __init__(self, scheduler, path, storage_class=FileStorage,
-                 host=DEFAULT_HOST, port=DEFAULT_PORT):
+    def __init__(self, scheduler, path, storage_class=SnapshotFileStorage,
+                 host=DEFAULT_HOST, port=DEFAULT_PORT,
+                 pack_slice=DEFAULT_PACK_SLICE, gcbytes=DEFAULT_GCBYTES,
+                 config=None, workers=0, cache_size=DEFAULT_CACHE_SIZE,
+                 log_size=DEFAULT_LOG_SIZE,
+                 push_interval=DEFAULT_PUSH_INTERVAL,
+                 max_commit_size=DEFAULT_MAX_COMMIT_SIZE,
+                 group_commit=DEFAULT_GROUP_COMMIT,
+                 max_open=DEFAULT_MAX_OPEN, idle_close=DEFAULT_IDLE_CLOSE,
+                 routes=None, process=None, metrics_port=0):
         self.path = os.path.abspath(path)
         self.scheduler = scheduler
         self.storage_class = storage_class
         self.host = host
         self.port = port
+        self.pack_slice = pack_slice
+        self.gcbytes = gcbytes
+        self.cache_size = cache_size
+        self.log_size = log_size
+        self.push_interval = push_interval
+        self.max_commit_size = max_commit_size
+        self.group_commit = group_commit
+        self.max_open = max_open
+        self.idle_close = idle_close
+        # Optional per-database settings, one section per database name.
+        self.config = RawConfigParser()
+        if config is not None:
+            self.config.read(config)
+        # Number of threads for storage calls; 0 runs them in the
+        # scheduler's own thread.
+        self.workers = workers
+        self.executor = None
+        # Addresses of the server processes databases are shared among,
+        # and the index of this one in them; None for the supervisor,
+        # which owns no databases.
+        self.routes = routes or []
+        self.process = process
+        # Port to serve metrics over HTTP on; 0 serves them only through
+        # the 'I' command.
+        self.metrics_port = metrics_port
+        self.finished_jobs = deque()
+        self.wakeup = None
         # Database name -> open storage mapping.  By default all are closed.
         self.clients = set()
         self.storages = {}
+        # Database name -> IDLE_STATE of a storage closed for being idle,
+        # and the number of requests in progress for each database.
+        self.idle = {}
+        self.busy = {}
+        # Database name -> signal of an open or close in progress.
+        self.pending = {}
+        self.metrics = Metrics()
 
     @coro
     def dispatch(self):
@@ -105,6 +451,9 @@ class Server(object):
         socket.bind(address)
         socket.listen(16)
         log(20, 'Listening on %s:%i' % address)
+        if self.workers:
+            yield self._start_executor()
+        self._start_tasks()
         while 1:
             client_socket, client_address = yield socket.accept()
             log(20, 'Connection from %s:%s' % client_address)
@@ -113,35 +462,434 @@ class Server(object):
                 args=(client_socket,),
                 )
 
+    def _start_tasks(self):
+        # Start the coroutines that run alongside those serving clients.
+        if self.metrics_port:
+            self.scheduler.add(self.serve_metrics)
+        if self.idle_close:
+            self.scheduler.add(self.close_idle_storages)
+        self.scheduler.add(self.pack_storages)
+
+    @coro
+    def serve_metrics(self):
+        """Answer each HTTP request on the metrics port with the text of
+        :meth:`Metrics.render`, whatever its method and path."""
+        socket = Socket()
+        address = (self.host, self.metrics_port)
+        socket.bind(address)
+        socket.listen(16)
+        log(20, 'Serving metrics on %s:%i' % address)
+        while 1:
+            client_socket, client_address = yield socket.accept()
+            self.scheduler.add(self.serve_scrape, args=(client_socket,))
+
+    @coro
+    def serve_scrape(self, client_socket):
+        f = client_socket.makefile()
+        try:
+            # Skip the request line and headers.
+            while 1:
+                line = yield f.readline(MAX_SCRAPE_LINE)
+                if not line.strip():
+                    break
+            yield f.write(self._scrape_response())
+            yield f.flush()
+        except (ConnectionClosed, SocketError):
+            pass
+        try:
+            yield f.close()
+        except (ConnectionClosed, SocketError):
+            pass
+
+    def _scrape_response(self):
+        text = self.metrics.render(self)
+        return join_bytes([
+            'HTTP/1.0 200 OK\r\n',
+            'Content-Type: text/plain; version=0.0.4\r\n',
+            'Content-Length: %s\r\n' % len(text),
+            '\r\n',
+            text,
+            ])
+
     @coro
     def serve_to_client(self, client_socket):
-        client = ConnectedClient(client_socket)
+        yield self.serve_client(ConnectedClient(client_socket))
+
+    @coro
+    def serve_client(self, client):
         # Initialize per-storage state for the new client.
+        client.cursors = dict(
+            (db_name, storage.d_log.end)
+            for db_name, storage in self.storages.items())
         client.invalid = dict(
-            (db_name, set()) for db_name in self.storages)
+            (db_name, OidSet()) for db_name in self.storages)
         client.unused_oids = dict(
-            (db_name, set()) for db_name in self.storages)
+            (db_name, OidSet()) for db_name in self.storages)
         self.clients.add(client)
         while not client.closed:
+            client.received = client.sent = 0
             try:
                 command = yield client.read(1)
             except (ConnectionClosed, SocketError):
                 break
             else:
-                if command in self.handlers:
-                    handler_name = self.handlers[command]
-                    handler = getattr(self, handler_name)
-                    yield handler(client)
-                elif command in self.db_handlers:
-                    handler_name = self.db_handlers[command]
-                    handler = getattr(self, handler_name)
-                    # Get database name.
-                    name_length = str_to_int4((yield client.read(4)))
-                    db_name = yield client.read(name_length)
-                    yield handler(client, db_name)
+                yield self._handle_command(client, command)
                 yield client.flush()
+                if client.protocol >= FRAMED_PROTOCOL:
+                    yield self.serve_frames(client)
+                    break
         log(20, 'Connection closed.')
-        self.clients.remove(client)
+        self._remove_client(client)
+
+    @coro
+    def _handle_command(self, client, command):
+        if command in self.handlers:
+            handler_name = self.handlers[command]
+            db_name = ''
+            args = (client,)
+        elif command in self.db_handlers:
+            handler_name = self.db_handlers[command]
+            # Get database name.
+            name_length = str_to_int4((yield client.read(4)))
+            db_name = yield client.read(name_length)
+            args = (client, db_name)
+        else:
+            return
+        handler = getattr(self, handler_name)
+        start = time()
+        failed = True
+        # Databases with requests in progress are not closed as idle.
+        self.busy[db_name] = self.busy.get(db_name, 0) + 1
+        try:
+            yield handler(*args)
+            failed = False
+        finally:
+            self.busy[db_name] -= 1
+            if not self.busy[db_name]:
+                del self.busy[db_name]
+            self._count_command(
+                client, handler_name[len('handle_'):], db_name,
+                time() - start, failed)
+
+    def _count_command(self, client, command, db_name, seconds, failed):
+        sent = client.sent
+        if isinstance(client, FramedRequest):
+            # The response is flushed after the handler returns.
+            sent += sum(len(data) for data in client.output)
+        self.metrics.command(
+            command, db_name, seconds, client.received, sent, failed)
+
+    @coro
+    def serve_frames(self, client):
+        # Each frame is a request id, a session number, a length, and
+        # that many bytes of a request or of the rest of a request being
+        # handled.  Requests in one session for one database are handled
+        # in the order they arrive; others are handled concurrently and
+        # answered as they finish.
+        log(20, 'Framed protocol %s', client.protocol)
+        self.scheduler.add(self.write_frames, args=(client,))
+        sessions = client.sessions
+        while 1:
+            try:
+                request_id = str_to_int4((yield client.read(4)))
+                number = str_to_int4((yield client.read(4)))
+                length = str_to_int4((yield client.read(4)))
+                data = yield client.read(length)
+            except (ConnectionClosed, SocketError):
+                break
+            request = client.requests.get(request_id)
+            if request is not None:
+                request.receive(data)
+                yield Signal(request)
+                continue
+            session = sessions.get(number)
+            if session is None:
+                session = sessions[number] = Session(
+                    client, number, self.storages)
+                self.clients.add(session)
+            command = data[:1]
+            if command == '.':
+                if number == 0:
+                    log(20, 'Disconnect')
+                    break
+                log(20, 'End session %s', number)
+                self._remove_client(sessions.pop(number))
+                continue
+            if command in self.db_handlers:
+                name_length = str_to_int4(data[1:5])
+                key = (number, data[5:5+name_length])
+            else:
+                key = (number, None)
+            request = FramedRequest(session, request_id, data)
+            client.requests[request_id] = request
+            if key in client.queues:
+                client.queues[key].append(request)
+            else:
+                client.queues[key] = deque([request])
+                self.scheduler.add(self.serve_queue, args=(client, key))
+        client.disconnected = True
+        for session in sessions.values():
+            if session is not client:
+                self._remove_client(session)
+        for request in client.requests.values():
+            yield Signal(request)
+        yield Signal((client, 'outbox'))
+
+    @coro
+    def serve_queue(self, client, key):
+        queue = client.queues[key]
+        try:
+            while queue and not client.disconnected:
+                request = queue[0]
+                try:
+                    command = yield request.read(1)
+                    yield self._handle_command(request, command)
+                    yield request.flush()
+                finally:
+                    del client.requests[request.request_id]
+                    queue.popleft()
+        except (ConnectionClosed, SocketError):
+            pass
+        except Exception:
+            # There is no way to answer a failed request with an error,
+            # so reset the connection as a failure on an unframed one
+            # does.  The client's waiting requests then fail instead of
+            # waiting for a response that will never come.
+            log(40, 'Request %s failed:\n%s', request.request_id,
+                format_exc())
+            client.disconnected = True
+            client.reset()
+        finally:
+            del client.queues[key]
+
+    @coro
+    def write_frames(self, client):
+        # The only coroutine writing to a framed connection, so that
+        # frames finished by concurrent requests are not interleaved.
+        outbox = client.outbox
+        while 1:
+            if outbox:
+                data = join_bytes(outbox)
+                outbox.clear()
+                try:
+                    yield client.write(data)
+                    yield client.flush()
+                except (ConnectionClosed, SocketError):
+                    break
+            elif client.disconnected:
+                break
+            else:
+                yield WaitForSignal((client, 'outbox'))
+        try:
+            yield client.close()
+        except (ConnectionClosed, SocketError):
+            pass
+
+    def _remove_client(self, client):
+        self.clients.discard(client)
+        for storage in self.storages.values():
+            storage.d_subscribers.discard(client)
+        for state in self.idle.values():
+            state['d_subscribers'].discard(client)
+
+    @coro
+    def _start_executor(self):
+        # Worker threads cannot resume coroutines themselves, so each
+        # finished job writes a byte to a loopback socket that
+        # collect_jobs is reading from.
+        listener = Socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        self.wakeup = create_connection(listener.getsockname())
+        wakeup_socket, address = yield listener.accept()
+        listener.close()
+        self.executor = StorageExecutor(self.workers, self._job_finished)
+        self.scheduler.add(self.collect_jobs, args=(wakeup_socket,))
+        log(20, 'Using %i storage worker threads' % self.workers)
+
+    def _job_finished(self, job):
+        # Called from a worker thread.
+        self.finished_jobs.append(job)
+        self.wakeup.send('.')
+
+    @coro
+    def collect_jobs(self, wakeup_socket):
+        """Resume coroutines waiting on jobs finished by worker threads."""
+        while 1:
+            yield wakeup_socket.recv(4096)
+            while self.finished_jobs:
+                job = self.finished_jobs.popleft()
+                yield Signal(job)
+
+    def _call(self, db_name, func, *args):
+        """Return a coroutine that calls ``func(*args)``.
+
+        Use this for every call that touches the storage of the named
+        database.  When worker threads are enabled, the call runs in a
+        worker after any calls already queued for that database, and
+        the coroutine finishes when it is done; otherwise the call runs
+        directly.
+        """
+        if self.executor is None:
+            return coro(func)(*args)
+        else:
+            return self._call_in_worker(db_name, func, args)
+
+    @coro
+    def _call_in_worker(self, db_name, func, args):
+        job = self.executor.submit(db_name, func, *args)
+        yield WaitForSignal(job)
+        if job.exc_info is not None:
+            raise job.exc_info[0], job.exc_info[1], job.exc_info[2]
+        raise StopIteration(job.result)
+
+    @coro
+    def pack_storages(self):
+        """Advance iterative packs of open storages in time-boxed slices.
+
+        Each storage with a packer in progress gets at most
+        `pack_slice` seconds of work, then a pause as long, so that
+        requests queued meanwhile run.  When no pack is in progress,
+        wait until :meth:`_start_pack` signals that one has begun.
+        """
+        while 1:
+            packing = [
+                (db_name, storage)
+                for db_name, storage in self.storages.items()
+                if storage.d_packer not in (None, PACK_STARTING)
+                ]
+            if not packing:
+                yield WaitForSignal((self, 'pack'))
+                continue
+            for db_name, storage in packing:
+                if self.storages.get(db_name) is not storage:
+                    continue
+                try:
+                    finished = yield self._call(
+                        db_name, self._step_packer, db_name, storage)
+                except Exception, e:
+                    log(40, 'Pack %s failed after %s steps: %s',
+                        db_name, storage.d_pack_steps, e)
+                    storage.d_packer = None
+                else:
+                    if finished and self.storages.get(db_name) is storage:
+                        yield self._finish_pack(db_name, storage)
+                yield Sleep(max(self.pack_slice, PACK_PAUSE))
+
+    def _make_packer(self, storage):
+        # Return the storage's packer in a tuple, as a generator returned
+        # by a call made without workers is run as a coroutine.
+        return (storage.get_packer(),)
+
+    def _step_packer(self, db_name, storage):
+        # Return True once the packer is exhausted.
+        packer = storage.d_packer
+        deadline = time() + self.pack_slice
+        try:
+            while 1:
+                step = packer.next()
+                storage.d_pack_steps += 1
+                if isinstance(step, str):
+                    storage.d_pack_status = step
+                    log(15, 'Pack %s %s', db_name, step)
+                if time() >= deadline:
+                    break
+        except StopIteration:
+            return True
+        log(10, 'Pack %s in progress, %s steps, last status %r',
+            db_name, storage.d_pack_steps, storage.d_pack_status)
+        return False
+
+    @coro
+    def close_idle_storages(self):
+        """Close storages that have gone unused for `idle_close`
+        seconds."""
+        while 1:
+            yield Sleep(self.idle_close / 2.0)
+            now = time()
+            for db_name, storage in self.storages.items():
+                if (now - storage.d_last_used >= self.idle_close and
+                    self._is_idle(db_name, storage)):
+                    yield self._close_idle(db_name, storage)
+
+    def _is_idle(self, db_name, storage):
+        # True if nothing is using the storage or waiting to.
+        return (db_name not in self.busy and
+                storage.d_packer is None and
+                storage.d_batch is None and
+                not storage.d_push_pending)
+
+    def _close_least_used(self):
+        # Close the least recently used idle storages over max_open.
+        excess = len(self.storages) - self.max_open
+        if not self.max_open or excess <= 0:
+            return
+        idle = sorted(
+            (storage.d_last_used, db_name)
+            for db_name, storage in self.storages.items()
+            if self._is_idle(db_name, storage))
+        for last_used, db_name in idle[:excess]:
+            self.scheduler.add(
+                self._close_idle, args=(db_name, self.storages[db_name]))
+
+    @coro
+    def _close_idle(self, db_name, storage):
+        # Close the storage, keeping the state clients depend on, so
+        # that _storage can reopen it on the next request.  Oids removed
+        # by packs go to the log first.
+        yield self._sync_storage(db_name, storage)
+        if (self.storages.get(db_name) is not storage or
+            not self._is_idle(db_name, storage)):
+            return
+        del self.storages[db_name]
+        self.idle[db_name] = dict(
+            (name, getattr(storage, name)) for name in IDLE_STATE)
+        # Closing may write out the file and an index snapshot, so it
+        # runs through _call like any other storage call.  Requests that
+        # arrive meanwhile wait in _storage until it is done.
+        pending = self.pending[db_name] = object()
+        try:
+            try:
+                yield self._call(db_name, storage.close)
+            except Exception:
+                log(40, 'Failed to close idle %s:\n%s', db_name,
+                    format_exc())
+            else:
+                log(20, 'Closed idle %s', db_name)
+        finally:
+            del self.pending[db_name]
+            yield Signal(pending)
+
+    @coro
+    def _start_pack(self, db_name, storage):
+        log(20, 'Pack %s started at %s' % (db_name, datetime.now()))
+        storage.d_packer = PACK_STARTING
+        storage.d_pack_steps = 0
+        storage.d_pack_status = None
+        # Make the packer in the storage's turn, as it reads and sets the
+        # state of the transaction being stored.
+        try:
+            storage.d_packer, = yield self._call(
+                db_name, self._make_packer, storage)
+        except Exception:
+            storage.d_packer = None
+            raise
+        if storage.d_packer is None:
+            log(20, 'Cannot iteratively pack, performing full pack.')
+            yield self._call(db_name, storage.pack)
+            yield self._finish_pack(db_name, storage)
+        else:
+            yield Signal((self, 'pack'))
+
+    @coro
+    def _finish_pack(self, db_name, storage):
+        storage.d_packer = None
+        storage.d_bytes_since_pack = 0
+        self.metrics.pack(db_name)
+        log(20, 'Pack %s completed at %s after %s steps' % (
+            db_name, datetime.now(), storage.d_pack_steps))
+        # Oids removed by the pack must be invalidated for all clients.
+        yield self._sync_storage(db_name, storage)
 
     # Server handlers.
 
@@ -156,23 +904,27 @@ class Server(object):
     def handle_enumerate_open(self, client):
         # E
         log(20, 'Enumerate open')
-        names = self.storages.keys()
+        names = list(
+            set(self.storages) | set(self.idle) | set(self.pending))
         yield self._handle_enumerate_database_names(client, names)
 
     @coro
     def _handle_enumerate_database_names(self, client, names):
-        yield client.write(int4_to_str(len(names)))
+        response = [int4_to_str(len(names))]
         for name in names:
-            yield client.write(int4_to_str(len(name)))
-            yield client.write(name)
+            response.append(int4_to_str(len(name)))
+            response.append(name)
+        yield client.write(join_bytes(response))
 
     @coro
     def handle_quit(self, client):
         # Q
         log(20, 'Quit')
-        for storage in self.storages.values():
+        for db_name, storage in self.storages.items():
             if storage is not None:
-                storage.close()
+                yield self._call(db_name, storage.close)
+        if self.executor is not None:
+            self.executor.shutdown()
         self.scheduler.stop()
 
     @coro
@@ -181,6 +933,28 @@ class Server(object):
         log(20, 'Version')
         yield client.write(PROTOCOL)
 
+    @coro
+    def handle_max_protocol(self, client):
+        # U
+        log(20, 'Max protocol')
+        yield client.write(int4_to_str(MAX_PROTOCOL))
+
+    @coro
+    def handle_set_protocol(self, client):
+        # F
+        version = min(str_to_int4((yield client.read(4))), MAX_PROTOCOL)
+        log(20, 'Set protocol %s', version)
+        client.connection.protocol = version
+        yield client.write(int4_to_str(version))
+
+    @coro
+    def handle_metrics(self, client):
+        # I
+        log(20, 'Metrics')
+        text = self.metrics.render(self)
+        yield client.write(int4_to_str(len(text)))
+        yield client.write(text)
+
     @coro
     def handle_disconnect(self, client):
         # .
@@ -189,6 +963,121 @@ class Server(object):
 
     # Database handlers.
 
+    def _db_option(self, db_name, option, default, convert=int):
+        """Return a per-database setting from the config file.
+
+        Fall back to `default` if the database has no such setting.
+        """
+        if self.config.has_option(db_name, option):
+            return convert(self.config.get(db_name, option))
+        return default
+
+    def _route(self, db_name):
+        """Return the address of the server process that owns the named
+        database, or None if it is served here.
+
+        A ``process`` setting in the config file assigns a database to
+        a process; others are assigned by a hash of their names.
+        """
+        if not self.routes:
+            return None
+        index = self._db_option(db_name, 'process', None)
+        if index is None:
+            index = int(md5(db_name).hexdigest()[:8], 16) % len(self.routes)
+        if index == self.process:
+            return None
+        return self.routes[index]
+
+    @coro
+    def _storage(self, db_name):
+        """Return a coroutine that returns the storage of the named
+        database, waiting for it to be opened or closed if that is in
+        progress, and reopening it if it was closed for being idle.
+
+        :raise KeyError: If the database is not open.
+        """
+        while 1:
+            storage = self.storages.get(db_name)
+            if storage is not None:
+                break
+            if db_name in self.pending:
+                yield WaitForSignal(self.pending[db_name])
+            elif db_name in self.idle:
+                log(20, 'Reopen %s', db_name)
+                storage = yield self._open_storage(db_name)
+                break
+            else:
+                raise KeyError(db_name)
+        storage.d_last_used = time()
+        raise StopIteration(storage)
+
+    def _open_storage(self, db_name):
+        # Open the file through _call, as reading its index can take a
+        # while.  Requests for the database wait in _storage until it is
+        # done, so mark it pending before the coroutine first runs.
+        pending = self.pending[db_name] = object()
+        return self._finish_open(db_name, pending)
+
+    @coro
+    def _finish_open(self, db_name, pending):
+        try:
+            storage, = yield self._call(
+                db_name, self._make_storage, db_name)
+            self._add_storage(db_name, storage)
+        finally:
+            del self.pending[db_name]
+            yield Signal(pending)
+        self._close_least_used()
+        raise StopIteration(storage)
+
+    def _make_storage(self, db_name):
+        # Return a 1-tuple, as _call runs a returned iterator as a
+        # coroutine.
+        return (self.storage_class(self._db_path(db_name)),)
+
+    def _add_storage(self, db_name, storage):
+        storage.d_bytes_since_pack = 0
+        storage.d_gcbytes = self._db_option(
+            db_name, 'gcbytes', self.gcbytes)
+        storage.d_load_record = {}
+        storage.d_cache = RecordCache(self._db_option(
+            db_name, 'cache_size', self.cache_size))
+        storage.d_log = InvalidationLog(self._db_option(
+            db_name, 'log_size', self.log_size))
+        storage.d_reserved = set()
+        storage.d_subscribers = set()
+        storage.d_push_interval = self._db_option(
+            db_name, 'push_interval', self.push_interval, float)
+        storage.d_push_pending = False
+        storage.d_max_commit_size = self._db_option(
+            db_name, 'max_commit_size', self.max_commit_size)
+        storage.d_group_commit = self._db_option(
+            db_name, 'group_commit', self.group_commit, float)
+        storage.d_batch = None
+        storage.d_packer = None
+        storage.d_pack_steps = 0
+        storage.d_pack_status = None
+        storage.d_last_used = time()
+        state = self.idle.pop(db_name, None)
+        if state is not None:
+            for name, value in state.items():
+                setattr(storage, name, value)
+            # The oids clients were allocated before the storage was
+            # closed must not be allocated again.
+            allocated = getattr(storage, 'allocated_unused_oids', None)
+            if allocated is not None:
+                for c in self.clients:
+                    if db_name in c.unused_oids:
+                        allocated.update(c.unused_oids[db_name])
+        self.storages[db_name] = storage
+        # Initialize per-storage state for each client that has none,
+        # including those that connected while the storage was closed.
+        for c in self.clients:
+            if db_name not in c.cursors:
+                c.cursors[db_name] = storage.d_log.end
+                c.invalid[db_name] = OidSet()
+                c.unused_oids[db_name] = OidSet()
+
     def _db_path(self, db_name):
         db_path = os.path.join(self.path, db_name + EXTENSION)
         db_path = os.path.abspath(db_path)
@@ -196,22 +1085,137 @@ class Server(object):
             raise RuntimeError('Malformed db name %s' % db_name)
         return db_path
 
-    def _handle_invalidations(self, db_name, oids):
+    def _handle_invalidations(self, db_name, oids, source=None):
+        if not oids:
+            return
+        storage = self.storages[db_name]
+        storage.d_cache.invalidate(oids)
+        invalidations = storage.d_log
+        invalidations.append(oids, source)
+        if invalidations.oids > invalidations.max_oids:
+            self._compact_log(db_name, storage)
+        self._schedule_push(db_name, storage)
+
+    def _schedule_push(self, db_name, storage):
+        if storage.d_subscribers and not storage.d_push_pending:
+            storage.d_push_pending = True
+            self.scheduler.add(
+                self.push_invalidations, args=(db_name, storage))
+
+    @coro
+    def push_invalidations(self, db_name, storage):
+        # Wait first, so that the invalidations of commits made close
+        # together are pushed together.  cogen never resumes a Sleep of
+        # no time, so an interval of 0 pushes at once.
+        if storage.d_push_interval > 0:
+            yield Sleep(storage.d_push_interval)
+        storage.d_push_pending = False
+        if self.storages.get(db_name) is not storage:
+            return
+        name = int4_to_str(len(db_name)) + db_name
+        end = storage.d_log.end
+        for session in list(storage.d_subscribers):
+            connection = session.connection
+            if connection.disconnected or (
+                session.cursors[db_name] == end
+                and not session.invalid[db_name]):
+                continue
+            response = self._pop_invalid(session, db_name)
+            if str_to_int4(response[:4]) == 0:
+                continue
+            data = int4_to_str(session.number) + name + response
+            connection.outbox.append(join_bytes([
+                int4_to_str(0), int4_to_str(len(data)), data]))
+            yield Signal((connection, 'outbox'))
+
+    def _compact_log(self, db_name, storage):
+        # Drop the entries every client has been sent.  If the log is
+        # still too long, drop its oldest entries down to half its
+        # limit.  Clients yet to be sent those are told to resync, or,
+        # if their protocol predates that, get their oids in a set of
+        # their own.
+        invalidations = storage.d_log
+        start = invalidations.start
+        cursors = [c.cursors[db_name] for c in self.clients]
+        invalidations.compact(min(
+            [cursor for cursor in cursors if cursor >= start]
+            + [invalidations.end]))
+        if invalidations.oids <= invalidations.max_oids:
+            return
+        start = cursor = invalidations.start
+        remaining = invalidations.oids
+        for oids, source in invalidations.entries:
+            if remaining <= invalidations.max_oids // 2:
+                break
+            remaining -= len(oids)
+            cursor += 1
+        dropped = invalidations.compact(cursor)
+        log(20, 'Invalidation log %s compacted to %s oids',
+            db_name, invalidations.oids)
         for c in self.clients:
-            c.invalid[db_name].update(oids)
+            position = c.cursors[db_name]
+            if position >= cursor or c.connection.protocol >= RESYNC_PROTOCOL:
+                continue
+            # Update the client's set once, as each update rebuilds it.
+            invalid = []
+            for oids, source in dropped[max(position - start, 0):]:
+                if source is not c:
+                    invalid.extend(oids)
+                    if source is None:
+                        # Oids removed by a pack; see _new_oids.
+                        storage.d_reserved.update(oids)
+            c.invalid[db_name].update(invalid)
+            c.cursors[db_name] = cursor
+
+    def _is_invalid(self, client, db_name, oid):
+        # True if client has yet to be sent oid as invalid.
+        return (oid in client.invalid[db_name] or
+                self.storages[db_name].d_log.is_invalid(
+                    oid, client.cursors[db_name], client.session))
 
+    def _pop_invalid(self, client, db_name):
+        # Take the oids the client has yet to be sent, as a count
+        # followed by the oids, and move its cursor to the end of the
+        # log, before a yield lets other commits add to it.
+        invalidations = self.storages[db_name].d_log
+        cursor = client.cursors[db_name]
+        client.cursors[db_name] = invalidations.end
+        invalid = client.invalid[db_name]
+        if cursor < invalidations.start:
+            invalid.clear()
+            return int4_to_str(RESYNC)
+        oids = invalidations.since(cursor, client.session)
+        if invalid:
+            oids.update(invalid)
+            invalid.clear()
+        return int4_to_str(len(oids)) + join_bytes(oids)
+
+    @coro
     def _new_oids(self, client, db_name, storage, count):
+        # Oids removed by a pack could be allocated again, so they are
+        # kept from clients until every client has been sent them.
         oids = []
+        invalidations = storage.d_log
+        reserved = storage.d_reserved
         while len(oids) < count:
-            oid = storage.new_oid()
-            for c in self.clients:
-                if oid in c.invalid[db_name]:
-                    oid = None
-                    break
-            if oid is not None:
-                oids.append(oid)
+            candidates = yield self._call(
+                db_name, self._allocate_oids, storage, count - len(oids))
+            # Check the candidates in bulk; they rarely clash.
+            fresh = set(candidates).difference(invalidations.positions)
+            for oid in reserved.intersection(fresh):
+                # Rare: left in clients' own sets by _compact_log.
+                if [c for c in self.clients if oid in c.invalid[db_name]]:
+                    fresh.discard(oid)
+                else:
+                    reserved.discard(oid)
+            if len(fresh) < len(candidates):
+                candidates = [oid for oid in candidates if oid in fresh]
+            oids.extend(candidates)
         client.unused_oids[db_name].update(oids)
-        return oids
+        raise StopIteration(oids)
+
+    def _allocate_oids(self, storage, count):
+        return [storage.new_oid() for i in xrange(count)]
 
     def _report_load_record(self, storage):
         if storage.d_load_record and is_logging(5):
@@ -219,20 +1223,65 @@ class Server(object):
                              for key, value
                              in sorted(storage.d_load_record.items())))
             storage.d_load_record.clear()
+        if storage.d_cache.max_bytes and is_logging(10):
+            log(10, 'Cache %s: %s', storage, storage.d_cache)
 
-    @coro
-    def _send_load_response(self, client, db_name, storage, oid):
-        if oid in client.invalid[db_name]:
-            yield client.write(STATUS_INVALID)
-        else:
+    def _read_records(self, storage, oids):
+        # Return a list of the record, or the error raised, for each oid.
+        results = []
+        for oid in oids:
             try:
-                record = storage.load(oid)
-            except KeyError:
+                results.append(storage.load(oid))
+            except (KeyError, ReadConflictError), e:
+                results.append(e)
+        return results
+
+    @coro
+    def _load_records(self, db_name, storage, oids):
+        # Return a dictionary mapping each oid to its record, or to the
+        # error raised when loading it.  Records not in the cache are
+        # loaded with a single storage call.
+        batch = storage.d_batch
+        if batch is not None and not batch.oids.isdisjoint(oids):
+            # Clients have been told these oids are invalid; wait until
+            # the records that replace them are stored.
+            yield WaitForSignal(batch)
+        cache = storage.d_cache
+        records = {}
+        missing = []
+        for oid in oids:
+            if oid not in records:
+                record = cache.get(oid)
+                if record is None:
+                    missing.append(oid)
+                records[oid] = record
+        if missing:
+            generation = cache.generation
+            results = yield self._call(
+                db_name, self._read_records, storage, missing)
+            for oid, result in zip(missing, results):
+                if not isinstance(result, Exception):
+                    cache.put(oid, result, generation)
+                records[oid] = result
+        raise StopIteration(records)
+
+    @coro
+    def _load_response(self, client, db_name, storage, oids):
+        # Return the responses to loading oids, joined in one string.
+        valid_oids = [oid for oid in oids
+                      if not self._is_invalid(client, db_name, oid)]
+        records = yield self._load_records(db_name, storage, valid_oids)
+        response = []
+        for oid in oids:
+            record = records.get(oid)
+            if record is None:
+                response.append(STATUS_INVALID)
+            elif isinstance(record, KeyError):
                 log(10, 'KeyError %s', str_to_int8(oid))
-                yield client.write(STATUS_KEYERROR)
-            except ReadConflictError:
+                response.append(STATUS_KEYERROR)
+            elif isinstance(record, ReadConflictError):
                 log(10, 'ReadConflictError %s', str_to_int8(oid))
-                yield client.write(STATUS_INVALID)
+                response.append(STATUS_INVALID)
             else:
                 if is_logging(5):
                     class_name = extract_class_name(record)
@@ -241,174 +1290,500 @@ class Server(object):
                     else:
                         storage.d_load_record[class_name] = 1
                     log(4, 'Load %-7s %s', str_to_int8(oid), class_name)
-                yield client.write(STATUS_OKAY)
-                yield client.write(int4_to_str(len(record)))
-                yield client.write(record)
+                response.append(STATUS_OKAY)
+                response.append(int4_to_str(len(record)))
+                response.append(record)
+        raise StopIteration(join_bytes(response))
 
+    @coro
+    def _prefetch_records(self, client, db_name, storage, record, depth,
+                          max_bytes):
+        # Return the records `record` refers to, breadth first, up to
+        # `depth` references away and `max_bytes` in total.  Records the
+        # client has yet to be sent as invalid are left out, as a load
+        # would refuse them.
+        seen = set([record[:8]])
+        level = [record]
+        prefetched = []
+        size = 0
+        for step in xrange(depth):
+            oids = []
+            for record in level:
+                for oid in split_oids(unpack_record(record)[2]):
+                    if oid not in seen:
+                        seen.add(oid)
+                        if not self._is_invalid(client, db_name, oid):
+                            oids.append(oid)
+            level = []
+            for start in xrange(0, len(oids), PREFETCH_BATCH_SIZE):
+                batch = oids[start:start + PREFETCH_BATCH_SIZE]
+                records = yield self._load_records(db_name, storage, batch)
+                for oid in batch:
+                    record = records[oid]
+                    if isinstance(record, Exception):
+                        continue
+                    size += len(record)
+                    if size > max_bytes:
+                        raise StopIteration(prefetched)
+                    level.append(record)
+                    prefetched.append(record)
+        raise StopIteration(prefetched)
+
+    @coro
     def _sync_storage(self, db_name, storage):
-        self._handle_invalidations(db_name, storage.sync())
+        oids = yield self._call(db_name, storage.sync)
+        self._handle_invalidations(db_name, oids)
+
+    @coro
+    def _read_transaction(self, client, tdata_len):
+        # Read a transaction of `tdata_len` bytes and return its (oid,
+        # record) pairs.  It is read COMMIT_CHUNK_SIZE bytes at a time,
+        # and each record is sliced once from the chunk holding it, so the
+        # transaction is never held as one string.  The rest of a record
+        # too long for a chunk is read as a string of its own.
+        records = []
+        unread = tdata_len
+        data = ''
+        while unread:
+            size = min(unread, COMMIT_CHUNK_SIZE)
+            chunk = yield client.read(size)
+            unread -= size
+            if data:
+                chunk = data + chunk
+            end = len(chunk)
+            i = 0
+            while end - i >= 4:
+                rlen = unpack_from('>L', chunk, i)[0]
+                if rlen < 8:
+                    raise ClientError('invalid record length: %r' % rlen)
+                j = i + 4 + rlen
+                if j <= end:
+                    records.append((chunk[i+4:i+12], chunk[i+12:j]))
+                    i = j
+                elif j - end <= COMMIT_CHUNK_SIZE:
+                    # The next chunk holds the rest.
+                    break
+                elif j - end > unread:
+                    break
+                else:
+                    oid = chunk[i+4:i+12]
+                    if len(oid) < 8:
+                        size = 8 - len(oid)
+                        oid += yield client.read(size)
+                        unread -= size
+                    size = j - max(end, i + 12)
+                    record = yield client.read(size)
+                    unread -= size
+                    if end > i + 12:
+                        record = chunk[i+12:] + record
+                    records.append((oid, record))
+                    i = end
+            data = chunk[i:]
+        if data:
+            raise ClientError('truncated transaction')
+        raise StopIteration(records)
+
+    @coro
+    def _read_chunks(self, client, max_size):
+        # Read a transaction sent in chunks and return its records and
+        # length.  Once the length is over `max_size`, if that is not 0,
+        # the rest is discarded and None is returned for the records.
+        records = []
+        tdata_len = 0
+        while 1:
+            size = str_to_int4((yield client.read(4)))
+            if size == 0:
+                break
+            tdata_len += size
+            if 0 < max_size < tdata_len:
+                records = None
+            if records is None:
+                yield self._skip(client, size)
+            else:
+                records.extend((yield self._read_transaction(client, size)))
+        raise StopIteration((records, tdata_len))
+
+    @coro
+    def _skip(self, client, size):
+        while size:
+            chunk_size = min(size, COMMIT_CHUNK_SIZE)
+            yield client.read(chunk_size)
+            size -= chunk_size
+
+    def _store_transaction(self, storage, records):
+        # Return the oids the storage reports as invalidated.
+        invalidations = []
+        storage.begin()
+        for oid, record in records:
+            storage.store(oid, record)
+        storage.end(handle_invalidations=invalidations.extend)
+        return invalidations
+
+    def _commit(self, db_name, storage, records):
+        """Return a coroutine that stores `records` as a transaction and
+        finishes with the oids the storage reports as invalidated."""
+        if storage.d_group_commit:
+            return self._join_batch(db_name, storage, records)
+        else:
+            return self._call(
+                db_name, self._store_transaction, storage, records)
+
+    @coro
+    def _join_batch(self, db_name, storage, records):
+        # Add the transaction to the batch gathering for the database,
+        # starting one if there is none, and wait until it is stored.
+        batch = storage.d_batch
+        if batch is None:
+            batch = storage.d_batch = CommitBatch()
+            self.scheduler.add(
+                self._store_batch, args=(db_name, storage, batch))
+        index = len(batch.transactions)
+        batch.transactions.append(records)
+        batch.oids.update(oid for oid, record in records)
+        yield WaitForSignal(batch)
+        invalidations, exc_info = batch.results[index]
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        raise StopIteration(invalidations)
+
+    @coro
+    def _store_batch(self, db_name, storage, batch):
+        yield Sleep(storage.d_group_commit)
+        storage.d_batch = None
+        try:
+            batch.results = yield self._call(
+                db_name, self._write_batch, storage, batch.transactions)
+        except Exception:
+            batch.results = [([], sys.exc_info())] * len(batch.transactions)
+        yield Signal(batch)
+
+    def _write_batch(self, storage, transactions):
+        # Store the transactions as one, and make them durable with one
+        # flush.  If that fails, store them one at a time so that each
+        # is answered for itself.  Return the (invalidations, exc_info)
+        # of each.
+        log(10, 'Group commit of %s transactions', len(transactions))
+        results = None
+        if len(transactions) > 1:
+            records = []
+            for transaction in transactions:
+                records.extend(transaction)
+            try:
+                invalidations = self._store_transaction(storage, records)
+            except Exception:
+                pass
+            else:
+                # The storage's invalidations go to the clients once.
+                results = [(invalidations, None)] + [
+                    ([], None)] * (len(transactions) - 1)
+        if results is None:
+            results = []
+            for records in transactions:
+                try:
+                    results.append(
+                        (self._store_transaction(storage, records), None))
+                except Exception:
+                    results.append(([], sys.exc_info()))
+        self._flush_storage(storage)
+        return results
+
+    def _flush_storage(self, storage):
+        # Write what a file storage has buffered through to the disk.
+        shelf = getattr(storage, 'shelf', None)
+        if shelf is not None:
+            shelf_file = shelf.get_file()
+            shelf_file.flush()
+            shelf_file.fsync()
+
+    def _has_conflict(self, client, db_name, storage, oids, cursor):
+        # True if another client committed one of the oids after this
+        # client was sent its invalid oids at `cursor`.
+        invalid = client.invalid[db_name]
+        for oid in oids:
+            if oid in invalid or storage.d_log.is_invalid(
+                oid, cursor, client.session):
+                return True
+        return False
 
     @coro
     def handle_bulk_read(self, client, db_name):
         # B
         log(20, 'Bulk read %s' % db_name)
-        storage = self.storages[db_name]
+        storage = yield self._storage(db_name)
         number_of_oids = str_to_int4((yield client.read(4)))
         oid_str_len = 8 * number_of_oids
         oid_str = yield client.read(oid_str_len)
         oids = split_oids(oid_str)
-        for oid in oids:
-            yield self._send_load_response(client, db_name, storage, oid)
+        response = yield self._load_response(client, db_name, storage, oids)
+        yield client.write(response)
+
+    @coro
+    def handle_check_records(self, client, db_name):
+        # H
+        log(20, 'Check records %s' % db_name)
+        storage = yield self._storage(db_name)
+        count = str_to_int4((yield client.read(4)))
+        # Each item is an oid followed by the digest of a cached record.
+        items = yield client.read(24 * count)
+        oids = [items[i:i+8] for i in xrange(0, 24 * count, 24)]
+        records = yield self._load_records(
+            db_name, storage, [oid for oid in oids
+                               if not self._is_invalid(client, db_name, oid)])
+        statuses = []
+        for i, oid in enumerate(oids):
+            record = records.get(oid)
+            if (isinstance(record, str)
+                and record_digest(record) == items[24*i+8:24*i+24]):
+                statuses.append(STATUS_OKAY)
+            else:
+                statuses.append(STATUS_INVALID)
+        log(10, 'Checked %s records', count)
+        yield client.write(join_bytes(statuses))
 
     @coro
     def handle_commit(self, client, db_name):
         # C
         log(20, 'Commit %s' % db_name)
-        storage = self.storages[db_name]
-        self._sync_storage(db_name, storage)
-        invalid = client.invalid[db_name]
-        yield client.write(int4_to_str(len(invalid)))
-        yield client.write(join_bytes(invalid))
+        storage = yield self._storage(db_name)
+        yield self._sync_storage(db_name, storage)
+        yield client.write(self._pop_invalid(client, db_name))
+        # Pushes may move the cursor before the transaction arrives.
+        cursor = client.cursors[db_name]
         yield client.flush()
-        invalid.clear()
         tdata_len = str_to_int4((yield client.read(4)))
+        if tdata_len == WRITE_SET:
+            count = str_to_int4((yield client.read(4)))
+            declared = split_oids((yield client.read(8 * count)))
+            if self._has_conflict(client, db_name, storage, declared, cursor):
+                log(20, 'Conflict found before transaction was sent')
+                self.metrics.conflict(db_name)
+                yield client.write(STATUS_INVALID)
+                return
+            # Invalidate the oids for other clients now, so that their
+            # commits of them while this transaction is sent conflict
+            # when checked.  They are invalidated again when stored, for
+            # clients that load them in the meantime.
+            self._handle_invalidations(db_name, declared, client.session)
+            yield client.write(STATUS_OKAY)
+            yield client.flush()
+            tdata_len = str_to_int4((yield client.read(4)))
         if tdata_len == 0:
             # Client decided not to commit (e.g. conflict)
             return
-        tdata = yield client.read(tdata_len)
-        logging_debug = is_logging(10)
-        logging_debug and log(10, 'Committing %s bytes', tdata_len)
-        storage.begin()
-        i = 0
-        oids = []
-        while i < tdata_len:
-            rlen = str_to_int4(tdata[i:i+4])
-            i += 4
-            oid = tdata[i:i+8]
-            record = tdata[i+8:i+rlen]
-            i += rlen
-            if logging_debug:
-                class_name = extract_class_name(record)
-                log(10, '  oid=%-6s rlen=%-6s %s',
-                    str_to_int8(oid), rlen, class_name)
-            storage.store(oid, record)
-            oids.append(oid)
-        assert i == tdata_len
-        oid_set = set(oids)
+        max_size = storage.d_max_commit_size
+        if tdata_len == CHUNKED_COMMIT:
+            records, tdata_len = yield self._read_chunks(client, max_size)
+        elif 0 < max_size < tdata_len:
+            yield self._skip(client, tdata_len)
+            records = None
+        else:
+            records = yield self._read_transaction(client, tdata_len)
+        if records is None:
+            log(20, 'Refused commit of %s bytes', tdata_len)
+            self.metrics.refuse(db_name)
+            if client.connection.protocol >= CHUNKED_COMMIT_PROTOCOL:
+                yield client.write(STATUS_TOO_LARGE)
+            else:
+                yield client.write(STATUS_INVALID)
+            return
+        oids = [oid for oid, record in records]
+        if is_logging(10):
+            log(10, 'Committing %s bytes', tdata_len)
+            for oid, record in records:
+                log(10, '  oid=%-6s rlen=%-6s %s', str_to_int8(oid),
+                    len(record) + 8, extract_class_name(record))
+        oid_set = OidSet(oids)
         for c in self.clients:
-            if c is not client:
-                if oid_set.intersection(c.unused_oids[db_name]):
+            if c is not client.session:
+                if not c.unused_oids[db_name].isdisjoint(oid_set):
                     raise ClientError('invalid oid: %r' % oid)
+        if self._has_conflict(client, db_name, storage, oids, cursor):
+            log(20, 'Conflict with concurrent commit')
+            self.metrics.conflict(db_name)
+            yield client.write(STATUS_INVALID)
+            return
+        # Invalidate for other clients before storing, so that commits
+        # checked while this one is stored see the conflict.
+        self._handle_invalidations(db_name, oids, client.session)
         try:
-            handle_invalidations = (
-                lambda oids: self._handle_invalidations(db_name, oids))
-            storage.end(handle_invalidations=handle_invalidations)
+            invalidations = yield self._commit(db_name, storage, records)
         except ConflictError:
             log(20, 'Conflict during commit')
+            self.metrics.conflict(db_name)
             yield client.write(STATUS_INVALID)
         else:
+            self._handle_invalidations(db_name, invalidations)
             self._report_load_record(storage)
             log(20, 'Committed %3s objects %s bytes at %s',
                 len(oids), tdata_len, datetime.now())
+            self.metrics.commit(db_name, tdata_len)
             yield client.write(STATUS_OKAY)
-            client.unused_oids[db_name] -= oid_set
-            for c in self.clients:
-                if c is not client:
-                    c.invalid[db_name].update(oids)
+            client.unused_oids[db_name].difference_update(oid_set)
             storage.d_bytes_since_pack += tdata_len + 8
+            if (storage.d_packer is None and
+                0 < storage.d_gcbytes <= storage.d_bytes_since_pack):
+                log(20, 'Pack %s triggered after %s bytes committed',
+                    db_name, storage.d_bytes_since_pack)
+                yield self._start_pack(db_name, storage)
 
     @coro
     def handle_destroy(self, client, db_name):
         # D
         log(20, 'Destroy %s' % db_name)
-        if db_name in self.storages:
+        if (db_name in self.storages or db_name in self.idle or
+            db_name in self.pending):
             # Do nothing if it's still in use.
             pass
+        elif self._route(db_name) is not None:
+            # Only the process that owns it knows if it is in use.
+            pass
         else:
             db_path = self._db_path(db_name)
             os.unlink(db_path)
+            if os.path.exists(db_path + SNAPSHOT_SUFFIX):
+                os.unlink(db_path + SNAPSHOT_SUFFIX)
 
     @coro
     def handle_load(self, client, db_name):
         # L
         log(20, 'Load %s' % db_name)
-        storage = self.storages[db_name]
+        storage = yield self._storage(db_name)
         oid = yield client.read(8)
-        yield self._send_load_response(client, db_name, storage, oid)
+        response = yield self._load_response(client, db_name, storage, [oid])
+        yield client.write(response)
+
+    @coro
+    def handle_prefetch(self, client, db_name):
+        # K
+        log(20, 'Prefetch %s' % db_name)
+        storage = yield self._storage(db_name)
+        oid = yield client.read(8)
+        depth = str_to_int4((yield client.read(4)))
+        max_bytes = min(str_to_int4((yield client.read(4))),
+                        MAX_PREFETCH_BYTES)
+        response = yield self._load_response(client, db_name, storage, [oid])
+        yield client.write(response)
+        records = []
+        if response[:1] == STATUS_OKAY:
+            records = yield self._prefetch_records(
+                client, db_name, storage, response[5:], depth, max_bytes)
+        log(10, 'prefetched: %s', len(records))
+        prefetched = [int4_to_str(len(records))]
+        for record in records:
+            prefetched.append(int4_to_str(len(record)))
+            prefetched.append(record)
+        yield client.write(join_bytes(prefetched))
 
     @coro
     def handle_new_oids(self, client, db_name):
         # M
         log(20, 'New OIDs %s' % db_name)
-        storage = self.storages[db_name]
+        storage = yield self._storage(db_name)
         count = ord((yield client.read(1)))
         log(10, 'oids: %s', count)
-        yield client.write(
-            join_bytes(self._new_oids(client, db_name, storage, count)))
+        oids = yield self._new_oids(client, db_name, storage, count)
+        yield client.write(join_bytes(oids))
 
     @coro
     def handle_new_oid(self, client, db_name):
         # N
         log(20, 'New OID %s' % db_name)
-        storage = self.storages[db_name]
-        yield client.write(self._new_oids(client, db_name, storage, 1)[0])
+        storage = yield self._storage(db_name)
+        oids = yield self._new_oids(client, db_name, storage, 1)
+        yield client.write(oids[0])
+
+    @coro
+    def handle_new_oid_ranges(self, client, db_name):
+        # R
+        log(20, 'New OID ranges %s' % db_name)
+        storage = yield self._storage(db_name)
+        count = min(str_to_int4((yield client.read(4))), MAX_NEW_OIDS)
+        log(10, 'oids: %s', count)
+        oids = yield self._new_oids(client, db_name, storage, count)
+        yield client.write(pack_oid_ranges(oids))
 
     @coro
     def handle_open(self, client, db_name):
         # O
         log(20, 'Open %s' % db_name)
-        if db_name not in self.storages:
-            db_path = self._db_path(db_name)
-            storage = self.storage_class(db_path)
-            storage.d_bytes_since_pack = 0
-            storage.d_load_record = {}
-            storage.d_packer = None
-            self.storages[db_name] = storage
-            # Initialize per-storage state for each client.
-            for c in self.clients:
-                c.invalid[db_name] = set()
-                c.unused_oids[db_name] = set()
+        address = self._route(db_name)
+        if address is not None:
+            raise ClientError(
+                '%s is served by %s:%s' % ((db_name,) + address))
+        while db_name in self.pending:
+            yield WaitForSignal(self.pending[db_name])
+        # A database closed for being idle is left closed until it is
+        # used.
+        if db_name not in self.storages and db_name not in self.idle:
+            yield self._open_storage(db_name)
 
     @coro
     def handle_pack(self, client, db_name):
         # P
         log(20, 'Pack %s' % db_name)
-        storage = self.storages[db_name]
+        storage = yield self._storage(db_name)
         if storage.d_packer is None:
-            log(20, 'Pack started at %s' % datetime.now())
-            storage.d_packer = storage.get_packer()
-            if storage.d_packer is None:
-                log(20, 'Cannot iteratively pack, performing full pack.')
-                storage.pack()
-                log(20, 'Pack completed at %s' % datetime.now())
+            yield self._start_pack(db_name, storage)
         else:
             log(20, 'Pack already in progress at %s' % datetime.now())
         yield client.write(STATUS_OKAY)
 
+    @coro
+    def handle_route(self, client, db_name):
+        # G
+        log(20, 'Route %s' % db_name)
+        address = self._route(db_name)
+        if address is None:
+            yield client.write(int4_to_str(0))
+        else:
+            port = str(address[1])
+            yield client.write(int4_to_str(len(port)) + port)
+
     @coro
     def handle_sync(self, client, db_name):
         # S
         log(20, 'Sync %s' % db_name)
-        storage = self.storages[db_name]
+        storage = yield self._storage(db_name)
         self._report_load_record(storage)
-        self._sync_storage(db_name, storage)
-        invalid = client.invalid[db_name]
-        log(8, 'Sync %s', len(invalid))
-        yield client.write(int4_to_str(len(invalid)))
-        yield client.write(join_bytes(invalid))
-        invalid.clear()
+        yield self._sync_storage(db_name, storage)
+        yield client.write(self._pop_invalid(client, db_name))
+
+    @coro
+    def handle_subscribe(self, client, db_name):
+        # W
+        log(20, 'Subscribe %s' % db_name)
+        if client.connection.protocol < PUSH_PROTOCOL:
+            yield client.write(STATUS_INVALID)
+        else:
+            storage = yield self._storage(db_name)
+            storage.d_subscribers.add(client.session)
+            # Push what the session has yet to be sent.
+            self._schedule_push(db_name, storage)
+            yield client.write(STATUS_OKAY)
 
     @coro
     def handle_close(self, client, db_name):
         # X
         log(20, 'Close %s' % db_name)
+        while db_name in self.pending:
+            yield WaitForSignal(self.pending[db_name])
         if db_name in self.storages:
-            self.storages[db_name].close()
-            del self.storages[db_name]
-            # Remove per-storage state for each client.
+            batch = self.storages[db_name].d_batch
+            if batch is not None:
+                # Store the commits gathered before closing.
+                yield WaitForSignal(batch)
+        if db_name in self.storages or db_name in self.idle:
+            if db_name in self.storages:
+                storage = self.storages.pop(db_name)
+                yield self._call(db_name, storage.close)
+            else:
+                del self.idle[db_name]
+            # Remove per-storage state for each client.  Those that
+            # connected while it was closed for being idle have none.
             for c in self.clients:
-                del c.invalid[db_name]
-                del c.unused_oids[db_name]
+                c.cursors.pop(db_name, None)
+                c.invalid.pop(db_name, None)
+                c.unused_oids.pop(db_name, None)
 
 
 def main():
@@ -422,20 +1797,106 @@ def main():
     parser.add_argument(
         '--port', type=int, default=DEFAULT_PORT,
         help='Port to serve on.')
-    # parser.add_argument(
-    #     '--gcbytes', type=int, default=DEFAULT_GCBYTES,
-    #     help='Number of bytes to transfer between packing.')
+    parser.add_argument(
+        '--gcbytes', type=int, default=DEFAULT_GCBYTES,
+        help='Number of bytes to transfer between packing.')
+    parser.add_argument(
+        '--config', type=str, default=None,
+        help='File containing per-database settings.')
+    parser.add_argument(
+        '--pack-slice', type=float, default=DEFAULT_PACK_SLICE,
+        help='Seconds to spend on each slice of an iterative pack.')
+    parser.add_argument(
+        '--cache-size', type=int, default=DEFAULT_CACHE_SIZE,
+        help='Bytes of records to cache for each open database.')
+    parser.add_argument(
+        '--log-size', type=int, default=DEFAULT_LOG_SIZE,
+        help='Invalidated oids to keep for each open database.')
+    parser.add_argument(
+        '--push-interval', type=float, default=DEFAULT_PUSH_INTERVAL,
+        help='Seconds to gather invalidations before pushing them.')
+    parser.add_argument(
+        '--max-commit-size', type=int, default=DEFAULT_MAX_COMMIT_SIZE,
+        help='Largest transaction to accept, in bytes; 0 accepts any.')
+    parser.add_argument(
+        '--group-commit', type=float, default=DEFAULT_GROUP_COMMIT,
+        help='Seconds to gather commits to store and flush together; '
+        '0 stores each on its own.')
+    parser.add_argument(
+        '--max-open', type=int, default=DEFAULT_MAX_OPEN,
+        help='Most databases to keep open; 0 keeps all open.')
+    parser.add_argument(
+        '--idle-close', type=float, default=DEFAULT_IDLE_CLOSE,
+        help='Seconds a database may go unused before it is closed; '
+        '0 keeps it open.')
+    parser.add_argument(
+        '--workers', type=int, default=0,
+        help='Number of threads for storage I/O; 0 uses none.')
+    parser.add_argument(
+        '--engine', choices=['cogen', 'asyncio'], default='cogen',
+        help='Event loop to serve clients from.')
+    parser.add_argument(
+        '--processes', type=int, default=0,
+        help='Number of server processes to share databases among; '
+        '0 serves them all from this one.')
+    parser.add_argument(
+        '--process', type=int, default=None,
+        help=SUPPRESS)
+    parser.add_argument(
+        '--metrics-port', type=int, default=0,
+        help='Port to serve metrics over HTTP on; 0 serves none.')
     parser.add_argument(
         '--loglevel', type=int, default=20,
         help='Logging level.')
     args = parser.parse_args()
     logger.setLevel(args.loglevel)
-    scheduler = Scheduler()
-    server = Server(
+    if args.engine == 'asyncio':
+        try:
+            from xdserver.aioserver import AsyncioScheduler, AsyncioServer
+        except ImportError:
+            parser.error('--engine=asyncio requires trollius')
+        scheduler = AsyncioScheduler()
+        server_class = AsyncioServer
+    else:
+        scheduler = Scheduler()
+        server_class = Server
+    # Server processes listen on the ports after the supervisor's.
+    routes = [
+        (args.host, args.port + 1 + index)
+        for index in xrange(args.processes)]
+    supervisor = None
+    port = args.port
+    metrics_port = args.metrics_port
+    if args.process is not None:
+        port = routes[args.process][1]
+        if metrics_port:
+            metrics_port += 1 + args.process
+    elif routes:
+        supervisor = Supervisor(routes, sys.argv[1:])
+        supervisor.start()
+    server = server_class(
         scheduler=scheduler,
         path=args.path,
         host=args.host,
-        port=args.port,
+        port=port,
+        pack_slice=args.pack_slice,
+        gcbytes=args.gcbytes,
+        config=args.config,
+        workers=args.workers,
+        cache_size=args.cache_size,
+        log_size=args.log_size,
+        push_interval=args.push_interval,
+        max_commit_size=args.max_commit_size,
+        group_commit=args.group_commit,
+        max_open=args.max_open,
+        idle_close=args.idle_close,
+        routes=routes,
+        process=args.process,
+        metrics_port=metrics_port,
         )
     scheduler.add(server.dispatch)
-    scheduler.run()
+    try:
+        scheduler.run()
+    finally:
+        if supervisor is not None:
+            supervisor.stop()
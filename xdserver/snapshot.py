@@ -0,0 +1,182 @@
+__all__ = [
+    'SnapshotFileStorage',
+    'SnapshotShelf',
+    ]
+
+import os
+
+from durus.file import File
+from durus.file_storage import FileStorage
+from durus.logger import log
+from durus.shelf import OffsetMap, Shelf, read_transaction_offsets
+from durus.utils import int8_to_str, str_to_int8, read_int8, join_bytes
+
+
+# Suffix of the snapshot file kept next to a database file.
+SNAPSHOT_SUFFIX = '.index'
+
+SNAPSHOT_PREFIX = 'XDINDEX1'
+
+# Bytes of the prefix and of the inode, offset map start, offset map
+# size, end and number of entries that follow it.
+SNAPSHOT_HEADER_SIZE = len(SNAPSHOT_PREFIX) + 5 * 8
+
+
+class SnapshotShelf(Shelf):
+    """A :class:`~durus.shelf.Shelf` that starts its index of the
+    records stored since the last pack from a snapshot file.
+
+    Opening a shelf reads the header of every record written after its
+    offset map.  When a snapshot written by
+    :meth:`SnapshotFileStorage.write_snapshot` matches the file, only the
+    records written after the snapshot are read.  A snapshot is removed
+    once it has been read, whether or not it matches, so that one left
+    behind by a server that did not close the file is never used.
+
+    :param file: Name of the file, which is created if it is missing.
+    :param repair: If true, truncate an incomplete transaction at the
+      end of the file instead of raising an error.
+    """
+
+    def __init__(self, file, repair=False):
+        file = File(file)
+        file.obtain_lock()
+        snapshot = _take_snapshot(file)
+        file.seek(0, 2)
+        if file.tell() == 0:
+            for result in self.generate_shelf(file=file, items=[]):
+                pass
+            snapshot = None
+        assert self.has_format(file)
+        self.file = file
+        self.file.seek(len(self.prefix))
+        n = read_int8(self.file)
+        self.file.seek(self.file.tell() + n)
+        self.offset_map = OffsetMap(self.file)
+        self.memory_index = {}
+        if snapshot is not None:
+            inode, start, size, end, index = snapshot
+            if (inode == file.stat().st_ino and
+                start == self.offset_map.get_start() and
+                size == self.offset_map.get_array_size() and
+                self.file.tell() <= end <= len(file)):
+                log(15, 'Index snapshot of %s has %s records; reading '
+                    'from %s of %s bytes', file.get_name(), len(index), end,
+                    len(file))
+                self.memory_index = index
+                self.file.seek(end)
+            else:
+                log(20, 'Index snapshot of %s does not match it',
+                    file.get_name())
+        while True:
+            transaction_offsets = read_transaction_offsets(
+                self.file, repair=repair)
+            if transaction_offsets is None:
+                break
+            self.memory_index.update(transaction_offsets)
+        self.file.seek_end()
+        self.unused_name_generator = None
+
+
+class SnapshotFileStorage(FileStorage):
+    """A :class:`~durus.file_storage.FileStorage` that writes a snapshot
+    of its index when it is closed and after each pack, so that it can
+    be opened again without reading every record stored since the last
+    pack.  See :class:`SnapshotShelf`.
+
+    The snapshot is kept in a file named after the database file, with
+    :data:`SNAPSHOT_SUFFIX` added.  Temporary and read-only storages do
+    not use snapshots.
+    """
+
+    def __init__(self, filename=None, readonly=False, repair=False):
+        if filename is None or readonly:
+            FileStorage.__init__(
+                self, filename, readonly=readonly, repair=repair)
+        else:
+            self.shelf = SnapshotShelf(filename, repair=repair)
+            self.pending_records = {}
+            self.allocated_unused_oids = set()
+            self.pack_extra = None
+            self.invalid = set()
+
+    def write_snapshot(self):
+        """Write the file through to the disk, then write the index of
+        the records stored in it since the last pack to the snapshot
+        file."""
+        shelf_file = self.shelf.get_file()
+        if shelf_file.is_temporary() or shelf_file.is_readonly():
+            return
+        shelf_file.flush()
+        shelf_file.fsync()
+        shelf_file.seek_end()
+        offset_map = self.shelf.get_offset_map()
+        index = self.shelf.memory_index
+        data = [
+            SNAPSHOT_PREFIX,
+            int8_to_str(shelf_file.stat().st_ino),
+            int8_to_str(offset_map.get_start()),
+            int8_to_str(offset_map.get_array_size()),
+            int8_to_str(shelf_file.tell()),
+            int8_to_str(len(index)),
+            ]
+        for oid, position in index.iteritems():
+            data.append(oid)
+            data.append(int8_to_str(position))
+        # Replace the snapshot only once the new one is on the disk.
+        path = shelf_file.get_name() + SNAPSHOT_SUFFIX
+        f = open(path + '.tmp', 'wb')
+        try:
+            f.write(join_bytes(data))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(path + '.tmp', path)
+        log(15, 'Wrote index snapshot of %s records for %s',
+            len(index), shelf_file.get_name())
+
+    def get_packer(self):
+        packer = FileStorage.get_packer(self)
+        shelf = self.shelf
+
+        def snapshot_packer():
+            for step in packer:
+                yield step
+            if self.shelf is not shelf:
+                self.write_snapshot()
+        return snapshot_packer()
+
+    def close(self):
+        try:
+            self.write_snapshot()
+        finally:
+            FileStorage.close(self)
+
+
+def _take_snapshot(file):
+    # Read and remove the snapshot of `file`.  Return its inode, offset
+    # map start and size, end and index, or None if there is none.
+    path = file.get_name() + SNAPSHOT_SUFFIX
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    os.unlink(path)
+    if (len(data) < SNAPSHOT_HEADER_SIZE or
+        not data.startswith(SNAPSHOT_PREFIX)):
+        return None
+    header = [
+        str_to_int8(data[i:i+8])
+        for i in xrange(len(SNAPSHOT_PREFIX), SNAPSHOT_HEADER_SIZE, 8)]
+    inode, start, size, end, count = header
+    if len(data) != SNAPSHOT_HEADER_SIZE + 16 * count:
+        return None
+    index = {}
+    for i in xrange(SNAPSHOT_HEADER_SIZE, len(data), 16):
+        index[data[i:i+8]] = str_to_int8(data[i+8:i+16])
+    return inode, start, size, end, index
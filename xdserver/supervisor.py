@@ -0,0 +1,96 @@
+__all__ = [
+    'Supervisor',
+    'start_server',
+    'wait_for_server',
+    ]
+
+import os
+from signal import SIGINT
+from socket import create_connection, error as socket_error
+import subprocess
+import sys
+from time import sleep, time
+
+from durus.logger import log
+
+
+# Command that runs a server process.
+SERVER_COMMAND = ['-c', 'from xdserver.server import main; main()']
+
+# Seconds to wait for a server process to accept connections.
+START_TIMEOUT = 30.0
+
+
+class Supervisor(object):
+    """Runs a server process for each of a list of addresses.
+
+    Each process is given the supervisor's own arguments, followed by
+    ``--process`` and its index, and so serves the databases assigned to
+    that index at its address.
+
+    :param routes: ``(host, port)`` address of each process.
+    :param argv: Command line arguments of the supervisor.
+    """
+
+    def __init__(self, routes, argv):
+        self.routes = routes
+        self.argv = argv
+        self.processes = []
+
+    def start(self):
+        """Start the server processes and wait until each accepts
+        connections."""
+        for index, address in enumerate(self.routes):
+            self.processes.append(
+                start_server(self.argv + ['--process', str(index)]))
+            log(20, 'Started process %i on %s:%s' % ((index,) + address))
+        for index, address in enumerate(self.routes):
+            wait_for_server(self.processes[index], address)
+
+    def stop(self):
+        """Ask the server processes to quit, as a client's ``quit()``
+        would, and wait for them to exit."""
+        for process, address in zip(self.processes, self.routes):
+            if process.poll() is None:
+                try:
+                    connection = create_connection(address)
+                    connection.sendall('Q')
+                    connection.close()
+                except socket_error:
+                    os.kill(process.pid, SIGINT)
+        for process in self.processes:
+            process.wait()
+        self.processes = []
+
+
+def start_server(argv):
+    """Start a server process with command line arguments `argv`.
+
+    :rtype: :class:`subprocess.Popen`
+    """
+    # Import xdserver from wherever this process did.
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    return subprocess.Popen(
+        [sys.executable] + SERVER_COMMAND + argv, env=env)
+
+
+def wait_for_server(process, address, timeout=START_TIMEOUT):
+    """Wait until the server `process` accepts connections at `address`.
+
+    :raise RuntimeError: If it exits or `timeout` seconds pass first.
+    """
+    deadline = time() + timeout
+    while 1:
+        if process.poll() is not None:
+            raise RuntimeError(
+                'Process for %s:%s exited with status %s' % (
+                    address + (process.returncode,)))
+        try:
+            create_connection(address).close()
+        except socket_error:
+            if time() > deadline:
+                raise RuntimeError(
+                    'Process for %s:%s did not start' % address)
+            sleep(0.05)
+        else:
+            return